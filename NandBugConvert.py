@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from halo import Halo
+
+from nandbug_platform import NandBugDumpFile, is_dump_container, ecc_fix
+from nandbug_platform import raw_to_container, container_to_raw
+from nandbug_platform import NBD_SUFFIX, PAGE_SIZE
+import bitstreams
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Convert a raw dump to a .nbd dump container, " +
+                    "or back")
+    parser.add_argument("input", help="raw dump or dump container")
+    parser.add_argument(
+        "output",
+        help="dump container if it ends with .nbd, raw dump otherwise")
+    parser.add_argument(
+        "--correct", action="store_true",
+        help="also correct bit flips, recording their count per page")
+    parser.add_argument(
+        "--jobs", type=int,
+        help="number of error correction processes (default: CPU count)")
+    parser.add_argument(
+        "--page-size", type=lambda x: int(x, 0),
+        help="page size of a raw input, spare area included (default: " +
+             "Google Home Mini layout)")
+    parser.add_argument(
+        "--pages-per-block", type=int,
+        help="number of pages per block of a raw input (default: " +
+             "Google Home Mini layout)")
+    args = parser.parse_args()
+
+    geometry = bitstreams.NandGeometry()
+    page_size = args.page_size or geometry.page_size
+    pages_per_block = args.pages_per_block or geometry.pages_per_block
+
+    container_input = is_dump_container(args.input)
+    container_output = args.output.endswith(NBD_SUFFIX)
+
+    if container_input and (args.page_size or args.pages_per_block):
+        parser.error("the geometry of a dump container can't be changed")
+
+    if args.correct and page_size != PAGE_SIZE:
+        parser.error("error correction is only supported " +
+                     f"with {PAGE_SIZE:#x}-byte pages")
+
+    if not args.correct and container_input == container_output:
+        parser.error("the input and output must have different formats")
+
+    spinner = Halo(text=f"Converting {args.input} to {args.output}",
+                   spinner="dots")
+    spinner.start()
+
+    if args.correct:
+        flips, flip_map = ecc_fix(args.input, args.output, args.jobs,
+                                  pages_per_block)
+    elif container_output:
+        raw_to_container(args.input, args.output, page_size,
+                         pages_per_block)
+    else:
+        container_to_raw(args.input, args.output)
+
+    spinner.succeed()
+
+    if args.correct:
+        print(f"Corrected {flips} errors")
+
+        uncorrectable = flip_map.count(-1)
+        if uncorrectable:
+            print(f"{uncorrectable} pages could not be corrected")
+
+    if container_output:
+        with NandBugDumpFile(args.output) as dump:
+            print(f"{dump.pages} pages, " +
+                  f"{len(dump.erased_pages())} erased pages elided")
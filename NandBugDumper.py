@@ -1,48 +1,179 @@
 #!/usr/bin/env python3
 
 import argparse
+import sys
 
 from halo import Halo
 
 from nandbug_platform import NandBugPlatform, NandBugFtdiFIFO
+from nandbug_platform import NandBugDumpPipeline, NandBugOnfi, PAGE_SIZE
+from nandbug_platform import page_digests, read_digests, diff_digests
 import bitstreams
 
 
+def verify(fifo, filename, geometry):
+    """
+    Compare the page digests sent by a Dump bitstream in hash mode
+    to those of an image
+
+        Returns:
+            The ordered list of pages which differ
+    """
+    spinner = Halo(text=f"Hashing {filename}", spinner="dots")
+    spinner.start()
+    expected = page_digests(filename, geometry.page_size)
+    spinner.succeed()
+
+    spinner = Halo(text="Receiving page digests", spinner="dots")
+    spinner.start()
+    actual = read_digests(fifo, geometry.pages)
+    spinner.succeed()
+
+    return diff_digests(expected, actual)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Dump the nand flash content")
-    parser.add_argument("filename", help="output filename")
+    parser.add_argument(
+        "filename",
+        help="output filename (image to compare with --verify), a dump " +
+             "container if it ends with .nbd")
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="only compare the flash content to filename, using page " +
+             "digests computed by the FPGA")
+    parser.add_argument(
+        "--correct", action="store_true",
+        help="correct bit flips while dumping")
+    parser.add_argument(
+        "--raw",
+        help="with --correct, also write the uncorrected dump to this file")
+    parser.add_argument(
+        "--elide-erased", action="store_true",
+        help="only send a marker for erased pages over USB, the dump " +
+             "being unchanged")
+    parser.add_argument(
+        "--jobs", type=int,
+        help="number of error correction processes (default: CPU count)")
+    parser.add_argument(
+        "--no-cache-read", action="store_true",
+        help="read pages one by one, for chips without cache read support")
+    parser.add_argument(
+        "--detect", action="store_true",
+        help="read the NAND Flash geometry and fastest timing mode from " +
+             "its ONFI parameter page")
+    parser.add_argument(
+        "--timing", choices=["fast", "safe", "custom"],
+        help="NAND bus timing profile (default: fast, or the detected " +
+             "timing mode with --detect)")
+    parser.add_argument(
+        "--timing-values", metavar="VALUES",
+        help="with --timing custom, timings in ns, e.g. tWP=25,tWH=15")
+    parser.add_argument(
+        "--nand-clock", type=float, metavar="MHZ",
+        help="clock the NAND Flash logic from the FPGA PLL at this " +
+             "frequency (default: 60 MHz FTDI clock)")
+    parser.add_argument(
+        "--rebuild", action="store_true",
+        help="rebuild bitstreams instead of using cached ones")
     args = parser.parse_args()
 
+    if args.verify and (args.correct or args.raw or args.elide_erased):
+        parser.error("--verify can't be used with --correct, --raw " +
+                     "or --elide-erased")
+
+    if args.raw and not args.correct:
+        parser.error("--raw requires --correct")
+
+    if args.detect:
+        spinner = Halo(text="Detecting the NAND Flash", spinner="dots")
+        spinner.start()
+        onfi = NandBugOnfi.detect(args.rebuild)
+        spinner.succeed(f"Detected {onfi}")
+
+        geometry = bitstreams.NandGeometry(timing_mode=onfi.timing_mode,
+                                           **onfi.geometry)
+    else:
+        geometry = bitstreams.NandGeometry()
+
+    if args.timing is None and args.detect:
+        timing = bitstreams.onfi_timing(onfi.timing_mode)
+    else:
+        timing = bitstreams.nand_timing(args.timing or "fast",
+                                        args.timing_values)
+
+    nand_clock = args.nand_clock * 1e6 if args.nand_clock else None
+
+    if args.correct and geometry.page_size != PAGE_SIZE:
+        raise Exception("Error correction is only supported " +
+                        f"with {PAGE_SIZE:#x}-byte pages")
+
     spinner = Halo(text="Configuring bitstream for dumping", spinner="dots")
     spinner.start()
 
     p = NandBugPlatform()
-    p.build(bitstreams.Dump(), do_program=True)
+    dump = bitstreams.Dump(cache_read=not args.no_cache_read,
+                           timing=timing, geometry=geometry,
+                           nand_clock=nand_clock, hash_pages=args.verify,
+                           framed=args.correct or args.elide_erased,
+                           elide_erased=args.elide_erased)
+    p.build(dump, do_program=True, rebuild=args.rebuild)
 
     spinner.succeed()
 
+    if args.verify:
+        fifo = NandBugFtdiFIFO(streaming=True)
+        pages = verify(fifo, args.filename, geometry)
+        fifo.close()
+
+        if not pages:
+            print(f"The flash content matches {args.filename}")
+            sys.exit(0)
+
+        blocks = sorted(set(page // geometry.pages_per_block
+                            for page in pages))
+        print(f"{len(pages)} pages differ, in {len(blocks)} blocks:")
+        print(", ".join(str(block) for block in blocks))
+        sys.exit(1)
+
     spinner = Halo(
         text=f"Dumping flash to {args.filename} (0 %)", spinner="dots")
     spinner.start()
 
-    fifo = NandBugFtdiFIFO()
-
-    f = open(args.filename, "wb")
-    total_size = 0
-
-    while total_size != 0x11000000:
+    def progress(total_size):
+        percent = int(total_size / geometry.size * 100)
+        spinner.text = f"Dumping flash to {args.filename} " + \
+                       f"({percent} %)"
+
+    fifo = NandBugFtdiFIFO(streaming=True)
+
+    if args.correct:
+        pipeline = NandBugDumpPipeline(
+            fifo, geometry.size, raw_filename=args.raw,
+            corrected_filename=args.filename, jobs=args.jobs, framed=True,
+            page_size=geometry.page_size,
+            pages_per_block=geometry.pages_per_block)
+    else:
+        pipeline = NandBugDumpPipeline(
+            fifo, geometry.size, raw_filename=args.filename,
+            framed=args.elide_erased, page_size=geometry.page_size,
+            pages_per_block=geometry.pages_per_block)
+    flips, flip_map = pipeline.run(progress)
+
+    fifo.close()
+    spinner.succeed()
 
-        data = fifo.read(256)
+    if args.elide_erased:
+        print(f"{len(pipeline.erased_pages)} erased pages were elided")
 
-        if data:
-            f.write(data)
-            total_size += len(data)
+    if args.correct:
+        print(f"Corrected {flips} errors")
 
-            if total_size % (128 * 1024):
-                percent = int(total_size / 0x11000000 * 100)
-                spinner.text = f"Dumping flash to {args.filename} " + \
-                               f"({percent} %)"
+        uncorrectable = flip_map.count(-1)
+        if uncorrectable:
+            print(f"{uncorrectable} pages could not be corrected")
 
-    f.close()
-    spinner.succeed()
+        if pipeline.timeout_pages:
+            print(f"{len(pipeline.timeout_pages)} pages timed out " +
+                  "while being read")
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import argparse
+
 from nmigen import *
 
 from halo import Halo
@@ -10,12 +12,20 @@ import bitstreams
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(
+        description="Connect the nand flash to the CPU")
+    parser.add_argument(
+        "--rebuild", action="store_true",
+        help="rebuild the bitstream instead of using a cached one")
+    args = parser.parse_args()
+
     spinner = Halo(
         text="Configuring bitstream for passthrough", spinner="dots")
     spinner.start()
 
     p = NandBugPlatform()
     p.build(bitstreams.Passthrough(), do_program=True,
+            rebuild=args.rebuild,
             nextpnr_opts="--ignore-loops"  # Unfortunatly needed
             )
 
@@ -1,181 +1,540 @@
 #!/usr/bin/env python3
 
 import argparse
+import mmap
+import os
 import tempfile
 import struct
+from collections import deque
 
 from halo import Halo
 
-import bchlib
-
 from nandbug_platform import NandBugPlatform, NandBugFtdiFIFO
+from nandbug_platform import NandBugDumpPipeline, NandBugService, PAGE_SIZE
+from nandbug_platform import NandBugOnfi, NandBugDumpFile, is_dump_container
+from nandbug_platform import diff_digests
 import bitstreams
 
 
-def nibble_swap(data):
-    result = bytearray()
-    for c in data:
-        result.append(((c & 0x0F) << 4) | ((c & 0xF0) >> 4))
-    return result
-
-
-def ecc_fix(infilename, outfilename):
-    data = open(infilename, "rb").read()
-
-    bch = bchlib.BCH(0x8003, 48)
+# Maximum number of blocks sent to the Program bitstream
+# and not acknowledged yet
+PROGRAM_WINDOW_BLOCKS = 2
 
-    f = open(outfilename, "wb")
+# Page address flag, requesting a cache program from the Program bitstream
+PROGRAM_CACHE = 1 << 23
 
-    total_flips = 0
-    for offset in range(len(data)//0x880):
-        page = data[offset*0x880:(offset+1)*0x880]
-        page_data = nibble_swap(page[:0x820])
-        page_ecc = nibble_swap(page[0x820:-6])
-        page_padding = page[-6:]
-        flips = bch.decode_inplace(page_data, page_ecc)
-        if flips > 0:
-            total_flips += flips
-        f.write(nibble_swap(page_data) + nibble_swap(page_ecc) + page_padding)
+NAND_STATUS_FAIL = 0x01
+NAND_STATUS_FAILC = 0x02
+NAND_STATUS_ARRAY_READY = 0x20
+NAND_STATUS_READY = 0x40
 
-    f.close()
 
-    return total_flips
+def _map_image(filename):
+    # Always returns a context manager, closing the image
+    if is_dump_container(filename):
+        return NandBugDumpFile(filename)
+    with open(filename, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return memoryview(b"")
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 
-def get_modified_blocks(before_filename, after_filename):
-    before_data = open(before_filename, "rb").read()
-    after_data = open(after_filename, "rb").read()
-
+def _page_masks(pages, geometry):
     modified_blocks = []
+    page_masks = {}
+    for page_index in pages:
+        block_index, page = divmod(page_index, geometry.pages_per_block)
+        if block_index not in page_masks:
+            modified_blocks.append(block_index)
+            page_masks[block_index] = 0
+        page_masks[block_index] |= 1 << page
+    return modified_blocks, page_masks
+
+
+def diff_images(before_filename, after_filename, geometry=None):
+    """
+    Compare two images, block by block
+
+    Both images are memory-mapped and compared one block at a time, pages
+    only being compared within blocks that differ. Two dump containers are
+    compared through their page index only.
+
+        Parameters:
+            before_filename : The current image
+            after_filename : The image to be programmed
+            geometry (NandGeometry): NAND Flash geometry
+
+        Returns:
+            (ordered list of modified blocks,
+             dict mapping each modified block to a mask of its modified pages)
+    """
+    geometry = geometry or bitstreams.NandGeometry()
+    page_size = geometry.page_size
+    block_size = geometry.block_size
+
+    if is_dump_container(before_filename) and \
+            is_dump_container(after_filename):
+        with NandBugDumpFile(before_filename) as before_dump, \
+                NandBugDumpFile(after_filename) as after_dump:
+            if before_dump.page_size != page_size or \
+                    after_dump.page_size != page_size:
+                raise Exception(f"Dumps must hold {page_size:#x}-byte pages")
+            pages = diff_digests(before_dump.digests(),
+                                 after_dump.digests())
+            return _page_masks((page for page in pages
+                                if page < before_dump.pages), geometry)
 
-    for page_index in range(0, len(before_data)//0x880):
-        before_page = before_data[page_index*0x880:(page_index+1)*0x880]
-        after_page = after_data[page_index*0x880:(page_index+1)*0x880]
-        if before_page != after_page:
-            block_index = page_index // 64
-            if block_index not in modified_blocks:
-                modified_blocks.append(block_index)
-
-    return modified_blocks
+    modified_blocks = []
+    page_masks = {}
+
+    with _map_image(before_filename) as before_data, \
+            _map_image(after_filename) as after_data:
+        data_size = len(before_data) - len(before_data) % page_size
+
+        for block_start in range(0, data_size, block_size):
+            block_end = min(block_start + block_size, data_size)
+            if before_data[block_start:block_end] == \
+                    after_data[block_start:block_end]:
+                continue
+
+            page_mask = 0
+            for page, offset in enumerate(range(block_start, block_end,
+                                                page_size)):
+                if before_data[offset:offset + page_size] != \
+                        after_data[offset:offset + page_size]:
+                    page_mask |= 1 << page
+
+            block_index = block_start // block_size
+            modified_blocks.append(block_index)
+            page_masks[block_index] = page_mask
+
+    return modified_blocks, page_masks
+
+
+def get_modified_blocks(before_filename, after_filename, geometry=None):
+    return diff_images(before_filename, after_filename, geometry)[0]
+
+
+def compare_image(fifo, data, progress=None, geometry=None):
+    """
+    Compare the NAND Flash to an image with the Compare bitstream
+
+    The whole image is sent, one block per write, mismatching pages being
+    reported by the bitstream meanwhile.
+
+        Parameters:
+            fifo : A NandBugFtdiFIFO, connected to a Compare bitstream
+            data : The expected image
+            progress : Optional callable, called with the number of pages
+                       sent so far
+            geometry (NandGeometry): NAND Flash geometry
+
+        Returns:
+            A dict mapping each mismatching page to its number of
+            differing bits
+    """
+    geometry = geometry or bitstreams.NandGeometry()
+    block_size = geometry.block_size
+
+    if len(data) != geometry.size:
+        raise Exception(f"The image must be {geometry.size:#x} bytes long")
+
+    for block_index in range(geometry.blocks):
+        fifo.write(data[block_index*block_size:(block_index+1)*block_size])
+        if progress:
+            progress((block_index+1) * geometry.pages_per_block)
+
+    mismatches = {}
+    report = bytearray(5)
+    while True:
+        fifo.readinto(report)
+        page_index, bits = struct.unpack("<IH", report[:3] + b"\0" +
+                                         report[3:])
+        if page_index == bitstreams.Compare.END_ADDRESS:
+            return mismatches
+        mismatches[page_index] = bits
+
+
+def erase_blocks(fifo, blocks, geometry=None):
+    """
+    Erase blocks with the Erase bitstream
+
+    All the block addresses are sent at once, acknowledgements are
+    checked once every block has been erased.
+
+        Parameters:
+            fifo : A NandBugFtdiFIFO, connected to an Erase bitstream
+            blocks : List of blocks to erase
+            geometry (NandGeometry): NAND Flash geometry
+    """
+    geometry = geometry or bitstreams.NandGeometry()
+    addresses = [struct.pack("<I", block_index*geometry.pages_per_block)[:3]
+                 for block_index in blocks]
+    fifo.write(b"".join(addresses))
+
+    acks = bytearray(4 * len(addresses))
+    fifo.readinto(acks)
+
+    for i, address in enumerate(addresses):
+        ack = acks[i*4:(i+1)*4]
+        if ack[:3] != address:
+            raise Exception(f"Unexpected acknowledgement {ack.hex()}, " +
+                            f"expected {address.hex()}")
+        if not ack[3] & NAND_STATUS_READY:
+            raise Exception(f"Timeout while erasing block {blocks[i]:#x}")
+        if ack[3] & NAND_STATUS_FAIL:
+            raise Exception(f"Failed to erase block {blocks[i]:#x}")
+
+
+def program_blocks(fifo, data, blocks, window=None, progress=None,
+                   geometry=None):
+    """
+    Program every page of blocks with the Program bitstream
+
+    A whole block is sent with a single write, and up to window pages are
+    kept in flight. Acknowledgements are checked as they come back.
+    Each block is written as a cache program run: every page but the last
+    one has the PROGRAM_CACHE flag set in its address.
+
+    The status of a cache program is read while the page is still being
+    programmed (ARDY cleared): FAIL isn't valid yet, and FAILC reports the
+    previous page of the run. The last page is programmed with 0x10, so
+    its FAIL bit is always valid.
+
+        Parameters:
+            fifo : A NandBugFtdiFIFO, connected to a Program bitstream
+            data : The image to program
+            blocks : List of blocks to program
+            window (int): Maximum number of unacknowledged pages,
+                          PROGRAM_WINDOW_BLOCKS blocks by default
+            progress : Optional callable, called with the number of pages
+                       programmed so far
+            geometry (NandGeometry): NAND Flash geometry
+    """
+    geometry = geometry or bitstreams.NandGeometry()
+    block_pages = geometry.pages_per_block
+    page_size = geometry.page_size
+    if window is None:
+        window = PROGRAM_WINDOW_BLOCKS * block_pages
+
+    pending = deque()
+    ack = bytearray(5)
+    programmed = 0
+
+    def check_ack():
+        nonlocal programmed
+
+        fifo.readinto(ack)
+        expected = pending.popleft()
+        if ack[:4] != expected:
+            raise Exception(f"Unexpected acknowledgement {ack.hex()}, " +
+                            f"expected {expected.hex()}")
+        page_index = struct.unpack("<I", expected[1:] + b"\0")[0]
+        page_index &= ~PROGRAM_CACHE
+        if not ack[4] & NAND_STATUS_READY:
+            raise Exception(f"Timeout while programming page {page_index:#x}")
+        if ack[4] & NAND_STATUS_FAILC and page_index % block_pages:
+            # Status of the previous page of the run
+            raise Exception(f"Failed to program page {page_index-1:#x}")
+        if ack[4] & NAND_STATUS_ARRAY_READY and ack[4] & NAND_STATUS_FAIL:
+            raise Exception(f"Failed to program page {page_index:#x}")
+
+        programmed += 1
+        if progress:
+            progress(programmed)
+
+    sequence = 0
+    for block_index in blocks:
+        frames = bytearray()
+        headers = []
+        for page_index in range(block_index*block_pages,
+                                (block_index+1)*block_pages):
+            address = page_index
+            if page_index != (block_index+1)*block_pages - 1:
+                address |= PROGRAM_CACHE
+            header = bytes([sequence]) + struct.pack("<I", address)[:3]
+            frames += header
+            frames += data[page_index*page_size:(page_index+1)*page_size]
+            headers.append(header)
+            sequence = (sequence + 1) % 256
+
+        while pending and len(pending) + len(headers) > window:
+            check_ack()
+
+        fifo.write(frames)
+        pending.extend(headers)
+
+    while pending:
+        check_ack()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(
         description="Patch the nand flash content")
-    parser.add_argument("filename", help="input filename")
+    parser.add_argument(
+        "filename", help="input filename, raw or a .nbd dump container")
     parser.add_argument(
         "--last-dump",
-        help="use this dump instead of reading the flash content")
+        help="use this dump (raw or a .nbd dump container) instead of " +
+             "reading the flash content")
+    parser.add_argument(
+        "--compare", action="store_true",
+        help="let the FPGA compare the flash content to filename, instead " +
+             "of dumping it")
+    parser.add_argument(
+        "--ignore-noise-bits", type=int, default=0, metavar="N",
+        help="with --compare, leave alone the pages which differ by at " +
+             "most N bits, assuming these are bit flips corrected by ECC " +
+             "(default: 0, any difference is programmed)")
+    parser.add_argument(
+        "--jobs", type=int,
+        help="number of error correction processes (default: CPU count)")
+    parser.add_argument(
+        "--detect", action="store_true",
+        help="read the NAND Flash geometry and fastest timing mode from " +
+             "its ONFI parameter page")
+    parser.add_argument(
+        "--timing", choices=["fast", "safe", "custom"],
+        help="NAND bus timing profile (default: fast, or the detected " +
+             "timing mode with --detect)")
+    parser.add_argument(
+        "--timing-values", metavar="VALUES",
+        help="with --timing custom, timings in ns, e.g. tWP=25,tWH=15")
+    parser.add_argument(
+        "--nand-clock", type=float, metavar="MHZ",
+        help="clock the NAND Flash logic from the FPGA PLL at this " +
+             "frequency (default: 60 MHz FTDI clock)")
+    parser.add_argument(
+        "--rebuild", action="store_true",
+        help="rebuild bitstreams instead of using cached ones")
+    parser.add_argument(
+        "--single-config", action="store_true",
+        help="configure the FPGA only once, with the Service bitstream")
     args = parser.parse_args()
 
+    if args.compare and (args.last_dump or args.single_config):
+        parser.error("--compare can't be used with --last-dump " +
+                     "or --single-config")
+
+    if args.ignore_noise_bits and not args.compare:
+        parser.error("--ignore-noise-bits requires --compare")
+
+    if args.detect:
+        spinner = Halo(text="Detecting the NAND Flash", spinner="dots")
+        spinner.start()
+        onfi = NandBugOnfi.detect(args.rebuild)
+        spinner.succeed(f"Detected {onfi}")
+
+        geometry = bitstreams.NandGeometry(timing_mode=onfi.timing_mode,
+                                           **onfi.geometry)
+    else:
+        geometry = bitstreams.NandGeometry()
+
+    if args.timing is None and args.detect:
+        timing = bitstreams.onfi_timing(onfi.timing_mode)
+    else:
+        timing = bitstreams.nand_timing(args.timing or "fast",
+                                        args.timing_values)
+
+    nand_clock = args.nand_clock * 1e6 if args.nand_clock else None
+
+    if not (args.last_dump or args.compare) and \
+            geometry.page_size != PAGE_SIZE:
+        raise Exception("Error correction of the dump is only supported " +
+                        f"with {PAGE_SIZE:#x}-byte pages")
+
+    if args.single_config:
+        spinner = Halo(
+            text="Configuring bitstream for all operations", spinner="dots")
+        spinner.start()
+
+        p = NandBugPlatform()
+        p.build(bitstreams.Service(timing=timing, geometry=geometry,
+                                   nand_clock=nand_clock),
+                do_program=True, rebuild=args.rebuild)
+
+        fifo = NandBugFtdiFIFO(streaming=True)
+        service = NandBugService(fifo, geometry.page_size)
+
+        spinner.succeed()
+    else:
+        service = None
+
     with tempfile.TemporaryDirectory() as tmpdir:
-        if not args.last_dump:
-            last_dump = f"{tmpdir}/dump.bin"
+        if args.compare:
             spinner = Halo(
-                text="Configuring bitstream for dumping", spinner="dots")
+                text="Configuring bitstream for comparing", spinner="dots")
             spinner.start()
 
             p = NandBugPlatform()
-            p.build(bitstreams.Dump(), do_program=True)
+            p.build(bitstreams.Compare(timing=timing, geometry=geometry,
+                                       nand_clock=nand_clock),
+                    do_program=True, rebuild=args.rebuild)
+
+            fifo = NandBugFtdiFIFO(streaming=True)
 
             spinner.succeed()
 
-            spinner = Halo(
-                text=f"Dumping flash to {last_dump} (0 %)", spinner="dots")
+            spinner = Halo(text="Comparing flash (0 %)", spinner="dots")
             spinner.start()
 
-            fifo = NandBugFtdiFIFO()
-
-            f = open(last_dump, "wb")
-            total_size = 0
+            def progress(pages):
+                percent = int(pages / geometry.pages * 100)
+                spinner.text = f"Comparing flash ({percent} %)"
 
-            while total_size != 0x11000000:
-                data = fifo.read(256)
-                if data:
-                    f.write(data)
-                    total_size += len(data)
-                    if total_size % (128 * 1024):
-                        percent = int(total_size / 0x11000000 * 100)
-                        spinner.text = f"Dumping flash to {last_dump} " + \
-                                       f"({percent} %)"
+            with _map_image(args.filename) as image:
+                mismatches = compare_image(fifo, image, progress, geometry)
 
-            f.close()
             fifo.close()
             spinner.succeed()
 
-            spinner = Halo(text="Performing error correction", spinner="dots")
+            noisy = sum(1 for bits in mismatches.values()
+                        if bits <= args.ignore_noise_bits)
+            if noisy:
+                print(f"{noisy} pages only differ by up to " +
+                      f"{args.ignore_noise_bits} bits, left as is")
+
+            modified_blocks, page_masks = _page_masks(
+                (page_index for page_index in sorted(mismatches)
+                 if mismatches[page_index] > args.ignore_noise_bits),
+                geometry)
+
+        elif not args.last_dump:
+            if not service:
+                spinner = Halo(
+                    text="Configuring bitstream for dumping", spinner="dots")
+                spinner.start()
+
+                p = NandBugPlatform()
+                p.build(bitstreams.Dump(timing=timing, geometry=geometry,
+                                        nand_clock=nand_clock, framed=True,
+                                        elide_erased=True),
+                        do_program=True, rebuild=args.rebuild)
+
+                fifo = NandBugFtdiFIFO(streaming=True)
+
+                spinner.succeed()
+
+            corrected_filename = f"{tmpdir}/dump_fixed.nbd"
+
+            spinner = Halo(
+                text=f"Dumping flash to {corrected_filename} (0 %)",
+                spinner="dots")
             spinner.start()
 
-            corrected_filename = f"{tmpdir}/dump_fixed.bin"
+            def progress(total_size):
+                percent = int(total_size / geometry.size * 100)
+                spinner.text = f"Dumping flash to {corrected_filename} " + \
+                               f"({percent} %)"
+
+            if service:
+                service.request_read(0, geometry.pages)
 
-            flips = ecc_fix(last_dump, corrected_filename)
+            pipeline = NandBugDumpPipeline(
+                fifo, geometry.size, corrected_filename=corrected_filename,
+                jobs=args.jobs, framed=not service,
+                page_size=geometry.page_size,
+                pages_per_block=geometry.pages_per_block)
+            flips, flip_map = pipeline.run(progress)
+
+            if not service:
+                fifo.close()
             spinner.succeed()
 
             print(f"Corrected {flips} errors")
 
+            uncorrectable = flip_map.count(-1)
+            if uncorrectable:
+                print(f"{uncorrectable} pages could not be corrected")
+
+            if pipeline.timeout_pages:
+                print(f"{len(pipeline.timeout_pages)} pages timed out " +
+                      "while being read")
+
             last_dump = corrected_filename
 
         else:
             last_dump = args.last_dump
 
-        modified_blocks = get_modified_blocks(last_dump, args.filename)
+        if not args.compare:
+            modified_blocks, page_masks = diff_images(last_dump,
+                                                      args.filename,
+                                                      geometry)
 
     if len(modified_blocks) == 0:
         print("Nothing to patch")
         exit(0)
 
-    print(f"{len(modified_blocks)} blocks will be modified")
+    modified_pages = sum(bin(mask).count("1") for mask in page_masks.values())
+    print(f"{len(modified_blocks)} blocks will be modified " +
+          f"({modified_pages} pages differ)")
 
-    spinner = Halo(
-        text="Configuring bitstream for erasing blocks", spinner="dots")
-    spinner.start()
+    if not service:
+        spinner = Halo(
+            text="Configuring bitstream for erasing blocks", spinner="dots")
+        spinner.start()
 
-    p = NandBugPlatform()
-    p.build(bitstreams.Erase(), do_program=True)
+        p = NandBugPlatform()
+        p.build(bitstreams.Erase(timing=timing, geometry=geometry,
+                                 nand_clock=nand_clock),
+                do_program=True, rebuild=args.rebuild)
 
-    spinner.succeed()
+        fifo = NandBugFtdiFIFO(streaming=True)
+
+        spinner.succeed()
 
     spinner = Halo(text=f"Erasing blocks", spinner="dots")
     spinner.start()
 
-    fifo = NandBugFtdiFIFO()
-
-    for block_index in modified_blocks:
-        addr = struct.pack("<I", block_index * 64)[:3]
-        fifo.write(addr)
-        while fifo.read(3) != addr:
-            pass
-
-    fifo.close()
+    if service:
+        for block_index in modified_blocks:
+            service.erase_block(block_index * geometry.pages_per_block)
+    else:
+        erase_blocks(fifo, modified_blocks, geometry)
 
     spinner.succeed()
 
-    spinner = Halo(
-        text="Configuring bitstream for programming pages", spinner="dots")
-    spinner.start()
+    if not service:
+        fifo.close()
 
-    p = NandBugPlatform()
-    p.build(bitstreams.Program(), do_program=True)
+        spinner = Halo(
+            text="Configuring bitstream for programming pages",
+            spinner="dots")
+        spinner.start()
 
-    fifo = NandBugFtdiFIFO()
+        p = NandBugPlatform()
+        p.build(bitstreams.Program(timing=timing, geometry=geometry,
+                                   nand_clock=nand_clock),
+                do_program=True, rebuild=args.rebuild)
 
-    spinner.succeed()
+        fifo = NandBugFtdiFIFO(streaming=True)
+
+        spinner.succeed()
 
     spinner = Halo(text="Writing pages (0 %)", spinner="dots")
     spinner.start()
 
-    data = open(args.filename, "rb").read()
-    for i, block_index in enumerate(modified_blocks):
-        for page_index in range(block_index*64, (block_index+1)*64):
-            addr = struct.pack("<I", page_index)[:3]
-            page_data = data[page_index*0x880:(page_index+1)*0x880]
-            fifo.write(addr)
-            for offset in range(0, 0x880//64):
-                fifo.write(page_data[offset*64:(offset+1)*64])
-            while fifo.read(3) != addr:
-                pass
-        percent = int((i+1) / len(modified_blocks) * 100.0)
+    block_pages = geometry.pages_per_block
+    page_size = geometry.page_size
+
+    def progress(programmed):
+        percent = int(programmed / (len(modified_blocks) * block_pages) * 100)
         spinner.text = f"Writing pages ({percent} %)"
 
+    with _map_image(args.filename) as data:
+        if service:
+            for i, block_index in enumerate(modified_blocks):
+                for page_index in range(block_index*block_pages,
+                                        (block_index+1)*block_pages):
+                    page_data = data[page_index*page_size:
+                                     (page_index+1)*page_size]
+                    service.program_page(page_index, page_data)
+                progress((i+1) * block_pages)
+        else:
+            program_blocks(fifo, data, modified_blocks, progress=progress,
+                           geometry=geometry)
+
+    fifo.close()
+
     spinner.succeed()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
 from .dump import Dump
+from .compare import Compare
 from .erase import Erase
 from .program import Program
 from .passthrough import Passthrough
+from .service import Service
+from .identify import Identify
+from .modules import NAND_TIMINGS, NandGeometry, nand_timing, onfi_timing
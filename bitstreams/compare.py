@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+from nmigen import *
+
+from .modules import *
+
+
+class Compare(Elaboratable):
+    """
+    Compare the whole NAND Flash to an image sent by the host
+
+    The host sends every page of the expected image, in order. Each page
+    is read from the NAND Flash (with the same sequence as Dump) and
+    compared to the expected one, buffered in block RAM.
+
+    Only mismatching pages are reported, with their page address (3 bytes,
+    little endian) and their number of differing bits (2 bytes, little
+    endian, saturated to 0xFFFF). The end of the comparison is reported
+    with END_ADDRESS as page address and 0 as bit count.
+    """
+
+    # Depth of the FTDI rx FIFO (bytes)
+    RX_DEPTH = 512
+
+    # Page address of the end of comparison report
+    END_ADDRESS = 0xFFFFFF
+
+    def __init__(self, cache_read=True, timing=None, geometry=None,
+                 nand_clock=None):
+        """
+            Parameters:
+                cache_read (bool): Use the sequential cache read commands
+                timing (dict): NandFSM bus timings, see nand_timing()
+                geometry (NandGeometry): NAND Flash geometry
+                nand_clock (float): NAND logic clock frequency (Hz), see
+                                    clock_domains()
+        """
+        self.cache_read = cache_read
+        self.timing = timing or nand_timing()
+        self.geometry = geometry or NandGeometry()
+        self.nand_clock = nand_clock
+
+    def elaborate(self, platform):
+
+        m = Module()
+
+        #
+        # Clock domains and status LED
+        #
+        clk_frequency, ftdi_domain = clock_domains(m, platform,
+                                                   self.nand_clock)
+
+        #
+        # FTDI FIFO Module
+        #
+        ftdi_fifo = FtdiFifo(ftdi_domain, rx_depth=self.RX_DEPTH)
+        m.submodules += ftdi_fifo
+
+        #
+        # Page Buffer Module, the next expected page is received
+        # while the current one is compared
+        #
+        page_buffer = PageBuffer(self.geometry.page_size)
+        m.submodules += page_buffer
+
+        # FTDI FIFO output always connected to the page buffer
+        m.d.comb += [page_buffer.w_data.eq(ftdi_fifo.rx_buffer.r_data),
+                     page_buffer.w_en.eq(ftdi_fifo.rx_buffer.r_rdy),
+                     ftdi_fifo.rx_buffer.r_en.eq(page_buffer.w_rdy)]
+
+        #
+        # NAND FSM Module
+        #
+        nand_fsm = NandFSM(timing_mode=self.geometry.timing_mode,
+                           clk_frequency=clk_frequency, **self.timing)
+        m.submodules += nand_fsm
+
+        # Light up the timeout LED if R/B# ever got stuck
+        timeout_led = platform.request("led", 2)
+        with m.If(nand_fsm.timeout):
+            m.d.sync += timeout_led.eq(1)
+
+        #
+        # Internal signals
+        #
+        page_address = Array([Signal(8) for _ in range(3)])
+        column_address = Array([Signal(8) for _ in
+                                range(self.geometry.column_cycles)])
+        address = Array([Signal(8) for _ in
+                         range(self.geometry.column_cycles +
+                               self.geometry.row_cycles)])
+
+        # Multi-purpose counter, large enough
+        # to count bytes in a page
+        counter = Signal(range(0, self.geometry.page_size + 1))
+
+        # Wire address to column_adrress + page_address
+        m.d.comb += Cat(*address).eq(Cat(*column_address, *page_address))
+
+        last_page = Signal()
+        m.d.comb += last_page.eq(
+            Cat(*page_address) == self.geometry.pages - 1)
+
+        # Number of differing bits in the current page
+        bit_errors = Signal(range(8 * self.geometry.page_size + 1))
+        report_bits = Signal(16)
+        m.d.comb += report_bits.eq(Mux(bit_errors > 0xFFFF, 0xFFFF,
+                                       bit_errors))
+
+        end = Signal()
+        report = Array([Mux(end, 0xFF, page_address[0]),
+                        Mux(end, 0xFF, page_address[1]),
+                        Mux(end, 0xFF, page_address[2]),
+                        Mux(end, 0x00, report_bits[:8]),
+                        Mux(end, 0x00, report_bits[8:])])
+
+        #
+        # Compare flash state machine
+        #
+        with m.FSM() as fsm:
+
+            #
+            # RESET the NAND Flash to a clean state
+            #
+
+            with m.State("RESET"):
+                # Send RESET command (0xFF)
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0xFF)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "WAIT_RESET"
+
+            with m.State("WAIT_RESET"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_RESET_READY"
+
+            with m.State("WAIT_RESET_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += counter.eq(0)
+                    m.next = "CMD1"
+
+            #
+            # Read each page
+            # the 0x30 command is used
+            #
+
+            with m.State("CMD1"):
+                # Start by sending the 0x00 CMD
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x00)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "ADDR"
+
+            with m.State("ADDR"):
+                # Send the 5 bytes of the address
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                with m.If(~nand_fsm.busy):
+                    with m.If(counter < len(address)):
+                        m.d.sync += nand_fsm.i_data.eq(address[counter])
+                        m.d.sync += nand_fsm.send_address.eq(1)
+                        m.d.sync += counter.eq(counter+1)
+                    with m.Else():
+                        m.d.sync += nand_fsm.send_address.eq(0)
+                        m.next = "CMD2"
+
+            with m.State("CMD2"):
+                # Finish with the 0x30 CMD
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x30)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "WAIT"
+
+            with m.State("WAIT"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_READY"
+
+            with m.State("WAIT_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += counter.eq(0)
+                    if self.cache_read:
+                        m.next = "CACHE_CMD"
+                    else:
+                        m.next = "READ"
+
+            #
+            # Move the page to the cache register, and start loading
+            # the next one (0x31), or end the cache read (0x3F)
+            #
+
+            with m.State("CACHE_CMD"):
+                with m.If(~nand_fsm.busy):
+                    with m.If(last_page):
+                        m.d.sync += nand_fsm.i_data.eq(0x3F)
+                    with m.Else():
+                        m.d.sync += nand_fsm.i_data.eq(0x31)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.next = "CACHE_WAIT"
+
+            with m.State("CACHE_WAIT"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "CACHE_WAIT_READY"
+
+            with m.State("CACHE_WAIT_READY"):
+                # Wait for the page to be in the cache register
+                with m.If(~nand_fsm.busy):
+                    m.next = "READ"
+
+            #
+            # Read the NAND Bus
+            # and compare it to the expected page
+            #
+
+            with m.State("READ"):
+                # Stream the whole page from the NAND FSM
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.stream_length.eq(
+                        self.geometry.page_size)
+                    m.d.sync += nand_fsm.read_stream.eq(1)
+                    m.d.sync += bit_errors.eq(0)
+                    m.next = "END_READ"
+
+            with m.State("END_READ"):
+                m.d.sync += nand_fsm.read_stream.eq(0)
+                m.next = "STREAM"
+
+            with m.State("STREAM"):
+                # Bytes are compared meanwhile
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += counter.eq(0)
+                    with m.If(bit_errors != 0):
+                        m.next = "REPORT"
+                    with m.Else():
+                        m.next = "INC_ADDR"
+
+            #
+            # Report the page address and its number of differing bits
+            # to the FTDI FIFO
+            #
+
+            with m.State("REPORT"):
+                with m.If(counter != len(report)):
+                    with m.If(ftdi_fifo.tx_buffer.w_rdy):
+                        m.d.comb += ftdi_fifo.tx_buffer.w_data.eq(
+                            report[counter])
+                        m.d.comb += ftdi_fifo.tx_buffer.w_en.eq(1)
+                        m.d.sync += counter.eq(counter+1)
+                with m.Else():
+                    with m.If(end):
+                        m.d.comb += ftdi_fifo.flush.eq(1)
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.next = "INC_ADDR"
+
+            #
+            # Increment address, loop back
+            #
+
+            with m.State("INC_ADDR"):
+                # If needed, increment the page address and loop back
+                with m.If(~last_page):
+                    m.d.sync += Cat(*page_address).eq(Cat(*page_address) + 1)
+                    if self.cache_read:
+                        m.next = "CACHE_CMD"
+                    else:
+                        m.next = "CMD1"
+                with m.Else():
+                    m.d.sync += end.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "REPORT"
+
+            with m.State("IDLE"):
+                pass
+
+        # NAND FSM stream output always compared to the page buffer output,
+        # the NAND Flash being read only once the expected byte is there
+        difference = Signal(8)
+        m.d.comb += [difference.eq(nand_fsm.stream_data ^ page_buffer.r_data),
+                     nand_fsm.stream_ready.eq(page_buffer.r_rdy),
+                     page_buffer.r_en.eq(nand_fsm.stream_valid)]
+        with m.If(nand_fsm.stream_valid):
+            m.d.sync += bit_errors.eq(
+                bit_errors + sum(difference[i] for i in range(8)))
+
+        return m
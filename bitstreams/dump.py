@@ -6,47 +6,157 @@ from .modules import *
 
 
 class Dump(Elaboratable):
+    """
+    Dump the whole NAND Flash to the FTDI FIFO
 
-    def __init__(self):
-        pass
+    In cache read mode, the first page is loaded with 0x00-0x30, then
+    each page is moved to the cache register with 0x31 (0x3F for the last
+    one), so that the next page loads into the data register while the
+    current one is streamed out.
+
+    Pages are double-buffered in block RAM: the next page is read from the
+    NAND Flash while the current one is sent to the FTDI.
+
+    In hash mode, only the CRC-32 of each page is sent (4 bytes, little
+    endian, as computed by zlib.crc32).
+
+    In framed mode, each page is preceded by a header byte, FRAME_HEADER
+    combined with the page flags:
+
+        - FRAME_DIRTY if the page isn't a valid BCH codeword, i.e. it needs
+          error correction (always set unless pages are 0x880 bytes long,
+          as in the Google Home Mini layout)
+        - FRAME_ERASED if every byte of the page is 0xFF
+        - FRAME_TIMEOUT if R/B# didn't go high in time while reading it
+        - FRAME_ELIDED if the page is erased and isn't sent, when erased
+          pages are elided: the header stands for the whole page
+    """
+
+    # Depth of the FTDI tx FIFO (bytes)
+    TX_DEPTH = 512
+
+    # Size of a page digest in hash mode (bytes)
+    DIGEST_SIZE = 4
+
+    # Frame header and page flags, in framed mode
+    FRAME_HEADER = 0xA0
+    FRAME_DIRTY = 0x01
+    FRAME_ERASED = 0x02
+    FRAME_TIMEOUT = 0x04
+    FRAME_ELIDED = 0x08
+
+    # BCH code used by the Google Home Mini, over its 0x880-byte pages:
+    # 0x820 bytes of data followed by 0x5A bytes of ECC, nibble-swapped
+    BCH_POLY = 0x8003
+    BCH_PAGE_SIZE = 0x880
+    BCH_CODEWORD_SIZE = 0x820 + 0x5A
+
+    def __init__(self, cache_read=True, timing=None, geometry=None,
+                 nand_clock=None, hash_pages=False, framed=False,
+                 elide_erased=False):
+        """
+            Parameters:
+                cache_read (bool): Use the sequential cache read commands
+                timing (dict): NandFSM bus timings, see nand_timing()
+                geometry (NandGeometry): NAND Flash geometry
+                nand_clock (float): NAND logic clock frequency (Hz), see
+                                    clock_domains()
+                hash_pages (bool): Send the CRC-32 of each page instead
+                                   of its content
+                framed (bool): Precede each page with a header byte
+                elide_erased (bool): In framed mode, only send the header
+                                     of erased pages
+        """
+        if hash_pages and framed:
+            raise Exception("Hash mode pages can't be framed")
+        if elide_erased and not framed:
+            raise Exception("Erased pages can only be elided in framed mode")
+
+        self.cache_read = cache_read
+        self.timing = timing or nand_timing()
+        self.geometry = geometry or NandGeometry()
+        self.nand_clock = nand_clock
+        self.hash_pages = hash_pages
+        self.framed = framed
+        self.elide_erased = elide_erased
 
     def elaborate(self, platform):
 
         m = Module()
 
         #
-        # Status LED Module
+        # Clock domains and status LED
         #
-        blink_led = platform.request("led", 0)
-        blinker = Blinker(blink_led, 0.5)
-        m.submodules += blinker
+        clk_frequency, ftdi_domain = clock_domains(m, platform,
+                                                   self.nand_clock)
 
         #
         # FTDI FIFO Module
         #
-        ftdi_fifo = FtdiFifo()
+        ftdi_fifo = FtdiFifo(ftdi_domain, tx_depth=self.TX_DEPTH)
         m.submodules += ftdi_fifo
 
+        if self.hash_pages:
+            #
+            # CRC-32 Module, computed on the fly from the NAND stream
+            #
+            crc = Crc32()
+            m.submodules += crc
+            digest = Array([crc.crc[i:i + 8] for i in range(0, 32, 8)])
+        else:
+            #
+            # Page Buffer Module, the next page is read from the NAND Flash
+            # while the previous one is sent to the FTDI
+            #
+            page_buffer = PageBuffer(self.geometry.page_size,
+                                     meta_width=3 if self.framed else 0)
+            m.submodules += page_buffer
+
+        if self.framed:
+            #
+            # BCH Syndrome Module, computed on the fly from the NAND stream
+            #
+            syndrome = BchSyndrome(self.BCH_POLY)
+            m.submodules += syndrome
+
         #
         # NAND FSM Module
         #
-        nand_fsm = NandFSM()
+        nand_fsm = NandFSM(timing_mode=self.geometry.timing_mode,
+                           clk_frequency=clk_frequency, **self.timing)
         m.submodules += nand_fsm
 
+        # Light up the timeout LED if R/B# ever got stuck
+        timeout_led = platform.request("led", 2)
+        with m.If(nand_fsm.timeout):
+            m.d.sync += timeout_led.eq(1)
+
         #
         # Internal signals
         #
         page_address = Array([Signal(8) for _ in range(3)])
-        column_address = Array([Signal(8) for _ in range(2)])
-        address = Array([Signal(8) for _ in range(5)])
+        column_address = Array([Signal(8) for _ in
+                                range(self.geometry.column_cycles)])
+        address = Array([Signal(8) for _ in
+                         range(self.geometry.column_cycles +
+                               self.geometry.row_cycles)])
 
         # Multi-purpose counter, large enough
         # to count bytes in a page
-        counter = Signal(range(0, 2177))
+        counter = Signal(range(0, self.geometry.page_size + 1))
 
         # Wire address to column_adrress + page_address
         m.d.comb += Cat(*address).eq(Cat(*column_address, *page_address))
 
+        last_page = Signal()
+        m.d.comb += last_page.eq(
+            Cat(*page_address) == self.geometry.pages - 1)
+
+        # Page flags, in framed mode
+        stream_count = Signal(range(0, self.geometry.page_size + 1))
+        dirty = Signal()
+        erased = Signal(reset=1)
+
         #
         # Dump flash state machine
         #
@@ -61,16 +171,20 @@ class Dump(Elaboratable):
                 with m.If(~nand_fsm.busy):
                     m.d.sync += nand_fsm.i_data.eq(0xFF)
                     m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
                     m.d.sync += counter.eq(0)
                     m.next = "WAIT_RESET"
 
             with m.State("WAIT_RESET"):
                 m.d.sync += nand_fsm.send_cmd.eq(0)
-                with m.If(counter == 500):
-                    m.next = "CMD1"
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_RESET_READY"
+
+            with m.State("WAIT_RESET_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
                     m.d.sync += counter.eq(0)
-                with m.Else():
-                    m.d.sync += counter.eq(counter + 1)
+                    m.next = "CMD1"
 
             #
             # Read each page
@@ -89,7 +203,7 @@ class Dump(Elaboratable):
                 # Send the 5 bytes of the address
                 m.d.sync += nand_fsm.send_cmd.eq(0)
                 with m.If(~nand_fsm.busy):
-                    with m.If(counter < 5):
+                    with m.If(counter < len(address)):
                         m.d.sync += nand_fsm.i_data.eq(address[counter])
                         m.d.sync += nand_fsm.send_address.eq(1)
                         m.d.sync += counter.eq(counter+1)
@@ -103,16 +217,48 @@ class Dump(Elaboratable):
                 with m.If(~nand_fsm.busy):
                     m.d.sync += nand_fsm.i_data.eq(0x30)
                     m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
                     m.d.sync += counter.eq(0)
                     m.next = "WAIT"
 
             with m.State("WAIT"):
                 m.d.sync += nand_fsm.send_cmd.eq(0)
-                with m.If(counter == 500):
-                    m.next = "READ"
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_READY"
+
+            with m.State("WAIT_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
                     m.d.sync += counter.eq(0)
-                with m.Else():
-                    m.d.sync += counter.eq(counter + 1)
+                    if self.cache_read:
+                        m.next = "CACHE_CMD"
+                    else:
+                        m.next = "READ"
+
+            #
+            # Move the page to the cache register, and start loading
+            # the next one (0x31), or end the cache read (0x3F)
+            #
+
+            with m.State("CACHE_CMD"):
+                with m.If(~nand_fsm.busy):
+                    with m.If(last_page):
+                        m.d.sync += nand_fsm.i_data.eq(0x3F)
+                    with m.Else():
+                        m.d.sync += nand_fsm.i_data.eq(0x31)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.next = "CACHE_WAIT"
+
+            with m.State("CACHE_WAIT"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "CACHE_WAIT_READY"
+
+            with m.State("CACHE_WAIT_READY"):
+                # Wait for the page to be in the cache register
+                with m.If(~nand_fsm.busy):
+                    m.next = "READ"
 
             #
             # Read the NAND Bus
@@ -120,46 +266,172 @@ class Dump(Elaboratable):
             #
 
             with m.State("READ"):
-                # Request a READ from the NAND FSM
-                m.d.sync += ftdi_fifo.tx_buffer.w_en.eq(0)
+                # Stream the whole page from the NAND FSM
                 with m.If(~nand_fsm.busy):
-                    m.d.sync += ftdi_fifo.tx_buffer.w_en.eq(0)
-                    m.d.sync += nand_fsm.read.eq(1)
+                    m.d.sync += nand_fsm.stream_length.eq(
+                        self.geometry.page_size)
+                    m.d.sync += nand_fsm.read_stream.eq(1)
                     m.next = "END_READ"
 
             with m.State("END_READ"):
-                m.d.sync += nand_fsm.read.eq(0)
-                m.next = "FIFO"
+                m.d.sync += nand_fsm.read_stream.eq(0)
+                m.next = "STREAM"
 
-            with m.State("FIFO"):
-                # Send the read data to the FTDI FIFO
-                with m.If(counter < 2176):
-                    with m.If(~nand_fsm.busy):
-                        with m.If(ftdi_fifo.tx_buffer.w_rdy):
-                            m.d.sync += ftdi_fifo.tx_buffer.w_en.eq(1)
-                            m.d.sync += counter.eq(counter+1)
-                            m.next = "READ"
-                with m.Else():
-                    m.d.sync += ftdi_fifo.tx_buffer.w_en.eq(0)
+            with m.State("STREAM"):
+                # Bytes go to the page buffer (or CRC) meanwhile
+                with m.If(~nand_fsm.busy):
                     m.d.sync += counter.eq(0)
+                    if self.hash_pages:
+                        m.next = "DIGEST"
+                    elif self.framed:
+                        m.next = "COMMIT"
+                    else:
+                        m.next = "INC_ADDR"
+
+            #
+            # Hand the page over along with its flags in framed mode
+            #
+
+            if self.framed:
+                with m.State("COMMIT"):
+                    m.d.comb += [page_buffer.w_meta.eq(
+                                     Cat(dirty, erased, nand_fsm.timeout)),
+                                 page_buffer.w_commit.eq(1),
+                                 syndrome.clear.eq(1)]
+                    m.d.sync += [stream_count.eq(0),
+                                 erased.eq(1)]
                     m.next = "INC_ADDR"
 
+            #
+            # Send the page CRC to the FTDI FIFO in hash mode
+            #
+
+            if self.hash_pages:
+                with m.State("DIGEST"):
+                    with m.If(counter != self.DIGEST_SIZE):
+                        with m.If(ftdi_fifo.tx_buffer.w_rdy):
+                            m.d.comb += ftdi_fifo.tx_buffer.w_data.eq(
+                                digest[counter])
+                            m.d.comb += ftdi_fifo.tx_buffer.w_en.eq(1)
+                            m.d.sync += counter.eq(counter+1)
+                    with m.Else():
+                        m.d.comb += crc.clear.eq(1)
+                        m.next = "INC_ADDR"
+
             #
             # Increment address, loop back
             #
 
             with m.State("INC_ADDR"):
                 # If needed, increment the page address and loop back
-                with m.If(Cat(*page_address) < 64 * 2048 - 1):
+                with m.If(~last_page):
                     m.d.sync += Cat(*page_address).eq(Cat(*page_address) + 1)
-                    m.next = "CMD1"
+                    if self.cache_read:
+                        m.next = "CACHE_CMD"
+                    else:
+                        m.next = "CMD1"
                 with m.Else():
+                    m.next = "FLUSH"
+
+            with m.State("FLUSH"):
+                # Send the end of the dump once out of the page buffer
+                if self.hash_pages:
+                    m.d.comb += ftdi_fifo.flush.eq(1)
                     m.next = "IDLE"
+                else:
+                    with m.If(page_buffer.empty):
+                        m.d.comb += ftdi_fifo.flush.eq(1)
+                        m.next = "IDLE"
 
             with m.State("IDLE"):
                 pass
 
-        # FTDI FIFO input always connected to NAND FSM output
-        m.d.comb += ftdi_fifo.tx_buffer.w_data.eq(nand_fsm.o_data)
+        if self.hash_pages:
+            # NAND FSM stream output always connected to the CRC
+            m.d.comb += [crc.data.eq(nand_fsm.stream_data),
+                         crc.valid.eq(nand_fsm.stream_valid),
+                         nand_fsm.stream_ready.eq(1)]
+        elif self.framed:
+            # NAND FSM stream output always connected to the page buffer
+            # and the page flags logic, bytes being nibble-swapped for the
+            # BCH syndrome
+            m.d.comb += [page_buffer.w_data.eq(nand_fsm.stream_data),
+                         page_buffer.w_en.eq(nand_fsm.stream_valid),
+                         nand_fsm.stream_ready.eq(page_buffer.w_rdy),
+                         syndrome.data.eq(Cat(nand_fsm.stream_data[4:],
+                                              nand_fsm.stream_data[:4])),
+                         syndrome.valid.eq(nand_fsm.stream_valid &
+                                           (stream_count <
+                                            self.BCH_CODEWORD_SIZE))]
+            if self.geometry.page_size == self.BCH_PAGE_SIZE:
+                m.d.comb += dirty.eq(syndrome.dirty)
+            else:
+                m.d.comb += dirty.eq(1)
+
+            with m.If(nand_fsm.stream_valid):
+                m.d.sync += stream_count.eq(stream_count + 1)
+                with m.If(nand_fsm.stream_data != 0xFF):
+                    m.d.sync += erased.eq(0)
+
+            # Page buffer output to the FTDI FIFO input, each page
+            # preceded by its header, erased pages being dropped
+            # from the page buffer if elided
+            elided = Signal()
+            if self.elide_erased:
+                m.d.comb += elided.eq(page_buffer.r_meta[1])
+
+            drain_count = Signal(range(0, self.geometry.page_size))
+            drain_last = Signal()
+            m.d.comb += drain_last.eq(
+                drain_count == self.geometry.page_size - 1)
+
+            with m.FSM(name="drain"):
+                with m.State("HEADER"):
+                    with m.If(page_buffer.r_rdy):
+                        m.d.comb += [
+                            ftdi_fifo.tx_buffer.w_data.eq(
+                                self.FRAME_HEADER |
+                                Cat(page_buffer.r_meta, elided)),
+                            ftdi_fifo.tx_buffer.w_en.eq(1)]
+                        with m.If(ftdi_fifo.tx_buffer.w_rdy):
+                            if self.elide_erased:
+                                with m.If(elided):
+                                    m.next = "SKIP"
+                                with m.Else():
+                                    m.next = "DATA"
+                            else:
+                                m.next = "DATA"
+
+                with m.State("DATA"):
+                    m.d.comb += [
+                        ftdi_fifo.tx_buffer.w_data.eq(page_buffer.r_data),
+                        ftdi_fifo.tx_buffer.w_en.eq(page_buffer.r_rdy),
+                        page_buffer.r_en.eq(ftdi_fifo.tx_buffer.w_rdy)]
+                    with m.If(page_buffer.r_rdy &
+                              ftdi_fifo.tx_buffer.w_rdy):
+                        with m.If(drain_last):
+                            m.d.sync += drain_count.eq(0)
+                            m.next = "HEADER"
+                        with m.Else():
+                            m.d.sync += drain_count.eq(drain_count + 1)
+
+                if self.elide_erased:
+                    with m.State("SKIP"):
+                        m.d.comb += page_buffer.r_en.eq(1)
+                        with m.If(page_buffer.r_rdy):
+                            with m.If(drain_last):
+                                m.d.sync += drain_count.eq(0)
+                                m.next = "HEADER"
+                            with m.Else():
+                                m.d.sync += drain_count.eq(drain_count + 1)
+        else:
+            # NAND FSM stream output always connected to the page buffer,
+            # and the page buffer to the FTDI FIFO input
+            m.d.comb += [page_buffer.w_data.eq(nand_fsm.stream_data),
+                         page_buffer.w_en.eq(nand_fsm.stream_valid),
+                         nand_fsm.stream_ready.eq(page_buffer.w_rdy),
+                         ftdi_fifo.tx_buffer.w_data.eq(page_buffer.r_data),
+                         ftdi_fifo.tx_buffer.w_en.eq(page_buffer.r_rdy),
+                         page_buffer.r_en.eq(ftdi_fifo.tx_buffer.w_rdy)]
 
         return m
@@ -1,46 +1,97 @@
 #!/usr/bin/env python3
 
 from nmigen import *
+from nmigen.lib.fifo import SyncFIFOBuffered
 
 from .modules import *
 
 
 class Erase(Elaboratable):
-
-    def __init__(self):
-        pass
+    """
+    Block erase bitstream
+
+    The host sends block addresses (3 bytes, little endian). They are
+    buffered as they arrive and erased back-to-back. Each erase is
+    acknowledged with the block address followed by the NAND status
+    register (0x70 command). If R/B# didn't go high in time, 0x00 is
+    reported as status (RDY bit cleared).
+    """
+
+    def __init__(self, address_depth=32, timing=None, geometry=None,
+                 nand_clock=None):
+        """
+            Parameters:
+                address_depth (int): Number of block addresses that can
+                                     be buffered
+                timing (dict): NandFSM bus timings, see nand_timing()
+                geometry (NandGeometry): NAND Flash geometry
+                nand_clock (float): NAND logic clock frequency (Hz), see
+                                    clock_domains()
+        """
+        self.address_depth = address_depth
+        self.timing = timing or nand_timing()
+        self.geometry = geometry or NandGeometry()
+        self.nand_clock = nand_clock
 
     def elaborate(self, platform):
 
         m = Module()
 
         #
-        # Status LED Module
+        # Clock domains and status LED
         #
-        blink_led = platform.request("led", 0)
-        blinker = Blinker(blink_led, 0.5)
-        m.submodules += blinker
+        clk_frequency, ftdi_domain = clock_domains(m, platform,
+                                                   self.nand_clock)
 
         #
         # FTDI FIFO Module
         #
-        ftdi_fifo = FtdiFifo()
+        ftdi_fifo = FtdiFifo(ftdi_domain)
         m.submodules += ftdi_fifo
 
         #
         # NAND FSM Module
         #
-        nand_fsm = NandFSM()
+        nand_fsm = NandFSM(timing_mode=self.geometry.timing_mode,
+                           clk_frequency=clk_frequency, **self.timing)
         m.submodules += nand_fsm
 
+        #
+        # Block addresses FIFO
+        #
+        address_fifo = SyncFIFOBuffered(width=24, depth=self.address_depth)
+        m.submodules += address_fifo
+
         #
         # Internal signals
         #
-        page_address = Array([Signal(8) for _ in range(3)])
+        page_address = [Signal(8) for _ in range(3)]
+        status = Signal(8)
+        address = Array(page_address[:self.geometry.row_cycles])
+        ack = Array([*page_address, status])
 
         # Multi-purpose counter, large enough
         # to count bytes in a page
-        counter = Signal(range(0, 2177))
+        counter = Signal(range(0, self.geometry.page_size + 1))
+
+        #
+        # Fill the address FIFO with the addresses
+        # received from the FTDI FIFO
+        #
+        rx_counter = Signal(range(3))
+        rx_address = Array([Signal(8) for _ in range(2)])
+
+        with m.If(ftdi_fifo.rx_buffer.r_rdy & address_fifo.w_rdy):
+            m.d.comb += ftdi_fifo.rx_buffer.r_en.eq(1)
+            with m.If(rx_counter != 2):
+                m.d.sync += rx_address[rx_counter].eq(
+                    ftdi_fifo.rx_buffer.r_data)
+                m.d.sync += rx_counter.eq(rx_counter + 1)
+            with m.Else():
+                m.d.comb += address_fifo.w_data.eq(
+                    Cat(*rx_address, ftdi_fifo.rx_buffer.r_data))
+                m.d.comb += address_fifo.w_en.eq(1)
+                m.d.sync += rx_counter.eq(0)
 
         #
         # Erase blocks state machine
@@ -56,29 +107,29 @@ class Erase(Elaboratable):
                     # Send RESET command (0xFF)
                     m.d.sync += nand_fsm.i_data.eq(0xFF)
                     m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
                     m.d.sync += counter.eq(0)
                     m.next = "WAIT_RESET"
 
             with m.State("WAIT_RESET"):
                 m.d.sync += nand_fsm.send_cmd.eq(0)
-                with m.If(counter == 500):
-                    m.next = "READ_ADDR"
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_RESET_READY"
+
+            with m.State("WAIT_RESET_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
                     m.d.sync += counter.eq(0)
-                with m.Else():
-                    m.d.sync += counter.eq(counter + 1)
+                    m.next = "READ_ADDR"
 
             #
-            # Read address from FTDI FIFO
+            # Pop the next address from the address FIFO
             #
 
             with m.State("READ_ADDR"):
-                with m.If(counter != 3):
-                    with m.If(ftdi_fifo.rx_buffer.r_rdy):
-                        m.d.sync += page_address[counter].eq(
-                            ftdi_fifo.rx_buffer.r_data)
-                        m.d.comb += ftdi_fifo.rx_buffer.r_en.eq(1)
-                        m.d.sync += counter.eq(counter+1)
-                with m.Else():
+                with m.If(address_fifo.r_rdy):
+                    m.d.sync += Cat(*page_address).eq(address_fifo.r_data)
+                    m.d.comb += address_fifo.r_en.eq(1)
                     m.d.sync += counter.eq(0)
                     m.next = "CMD1"
 
@@ -98,8 +149,8 @@ class Erase(Elaboratable):
                 # Send the 3 bytes of the address
                 m.d.sync += nand_fsm.send_cmd.eq(0)
                 with m.If(~nand_fsm.busy):
-                    with m.If(counter < 3):
-                        m.d.sync += nand_fsm.i_data.eq(page_address[counter])
+                    with m.If(counter < len(address)):
+                        m.d.sync += nand_fsm.i_data.eq(address[counter])
                         m.d.sync += nand_fsm.send_address.eq(1)
                         m.d.sync += counter.eq(counter+1)
                         m.next = "ADDR"
@@ -112,32 +163,71 @@ class Erase(Elaboratable):
                 with m.If(~nand_fsm.busy):
                     m.d.sync += nand_fsm.i_data.eq(0xD0)
                     m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
                     m.d.sync += counter.eq(0)
                     m.next = "WAIT"
 
             with m.State("WAIT"):
                 m.d.sync += nand_fsm.send_cmd.eq(0)
-                with m.If(counter == 500):
-                    with m.If(~nand_fsm.busy):
-                        m.next = "SEND_ADDR"
-                        m.d.sync += counter.eq(0)
-                with m.Else():
-                    m.d.sync += counter.eq(counter + 1)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_READY"
+
+            with m.State("WAIT_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += counter.eq(0)
+                    m.next = "STATUS_CMD"
+
+            #
+            # Read the NAND status register
+            #
+
+            with m.State("STATUS_CMD"):
+                with m.If(nand_fsm.timeout):
+                    # Report the timeout with the RDY bit cleared
+                    m.d.sync += status.eq(0x00)
+                    m.next = "SEND_ADDR"
+                # Send the 0x70 CMD
+                with m.Elif(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x70)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "STATUS_WAIT"
+
+            with m.State("STATUS_WAIT"):
+                # The NAND FSM holds the read until tWHR is respected
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.next = "STATUS_READ"
+
+            with m.State("STATUS_READ"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.read.eq(1)
+                    m.next = "STATUS_END_READ"
+
+            with m.State("STATUS_END_READ"):
+                m.d.sync += nand_fsm.read.eq(0)
+                m.next = "STATUS"
+
+            with m.State("STATUS"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += status.eq(nand_fsm.o_data)
+                    m.next = "SEND_ADDR"
 
             #
-            # Send back the address to FTDI FIFO
+            # Send back the address and status to FTDI FIFO
             # (acknowledge the erase command)
             # and loop back
             #
 
             with m.State("SEND_ADDR"):
-                with m.If(counter != 3):
+                with m.If(counter != 4):
                     with m.If(ftdi_fifo.tx_buffer.w_rdy):
                         m.d.comb += ftdi_fifo.tx_buffer.w_data.eq(
-                            page_address[counter])
+                            ack[counter])
                         m.d.comb += ftdi_fifo.tx_buffer.w_en.eq(1)
                         m.d.sync += counter.eq(counter+1)
                 with m.Else():
+                    m.d.comb += ftdi_fifo.flush.eq(1)
                     m.d.sync += counter.eq(0)
                     m.next = "READ_ADDR"
 
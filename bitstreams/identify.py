@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+from nmigen import *
+
+from .modules import *
+
+
+class Identify(Elaboratable):
+    """
+    NAND Flash identification bitstream
+
+    Once configured, the bitstream resets the NAND Flash and sends to the
+    FTDI FIFO:
+
+        - 8 bytes of READ ID (0x90) at address 0x00 (JEDEC ID)
+        - 4 bytes of READ ID (0x90) at address 0x20 ("ONFI" signature)
+        - 768 bytes of READ PARAMETER PAGE (0xEC), i.e. the parameter
+          page and its first two redundant copies
+
+    See nandbug_platform.NandBugOnfi to decode them.
+    """
+
+    ID_SIZE = 8
+    ONFI_ID_SIZE = 4
+    PARAMETER_PAGE_SIZE = 3 * 256
+
+    def __init__(self, timing=None):
+        """
+            Parameters:
+                timing (dict): NandFSM bus timings, see nand_timing(),
+                               defaults to the "safe" profile as the
+                               NAND Flash timing mode is yet unknown
+        """
+        self.timing = timing or nand_timing("safe")
+
+    def elaborate(self, platform):
+
+        m = Module()
+
+        #
+        # Status LED Module
+        #
+        blink_led = platform.request("led", 0)
+        blinker = Blinker(blink_led, 0.5)
+        m.submodules += blinker
+
+        #
+        # FTDI FIFO Module
+        #
+        ftdi_fifo = FtdiFifo()
+        m.submodules += ftdi_fifo
+
+        #
+        # NAND FSM Module
+        #
+        nand_fsm = NandFSM(**self.timing)
+        m.submodules += nand_fsm
+
+        #
+        # Internal signals
+        #
+
+        # Which READ ID is being done, 0x00 then 0x20
+        id_index = Signal()
+
+        #
+        # Identification state machine
+        #
+        with m.FSM() as fsm:
+
+            #
+            # RESET the NAND Flash to a clean state
+            #
+
+            with m.State("RESET"):
+                # Send RESET command (0xFF)
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0xFF)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.next = "WAIT_RESET"
+
+            with m.State("WAIT_RESET"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_RESET_READY"
+
+            with m.State("WAIT_RESET_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
+                    m.next = "ID_CMD"
+
+            #
+            # READ ID, at address 0x00 then 0x20
+            #
+
+            with m.State("ID_CMD"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x90)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.next = "ID_ADDR"
+
+            with m.State("ID_ADDR"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.next = "ID_ADDR_SEND"
+
+            with m.State("ID_ADDR_SEND"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(Mux(id_index, 0x20, 0x00))
+                    m.d.sync += nand_fsm.send_address.eq(1)
+                    m.next = "ID_ADDR_END"
+
+            with m.State("ID_ADDR_END"):
+                m.d.sync += nand_fsm.send_address.eq(0)
+                m.next = "ID_READ"
+
+            with m.State("ID_READ"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.stream_length.eq(
+                        Mux(id_index, self.ONFI_ID_SIZE, self.ID_SIZE))
+                    m.d.sync += nand_fsm.read_stream.eq(1)
+                    m.next = "ID_READ_END"
+
+            with m.State("ID_READ_END"):
+                m.d.sync += nand_fsm.read_stream.eq(0)
+                m.next = "ID_STREAM"
+
+            with m.State("ID_STREAM"):
+                with m.If(~nand_fsm.busy):
+                    with m.If(~id_index):
+                        m.d.sync += id_index.eq(1)
+                        m.next = "ID_CMD"
+                    with m.Else():
+                        m.next = "PARAM_CMD"
+
+            #
+            # READ PARAMETER PAGE
+            #
+
+            with m.State("PARAM_CMD"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0xEC)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.next = "PARAM_ADDR"
+
+            with m.State("PARAM_ADDR"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.next = "PARAM_ADDR_SEND"
+
+            with m.State("PARAM_ADDR_SEND"):
+                # The NAND Flash goes busy (tR) once the address is sent
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x00)
+                    m.d.sync += nand_fsm.send_address.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.next = "PARAM_WAIT"
+
+            with m.State("PARAM_WAIT"):
+                m.d.sync += nand_fsm.send_address.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "PARAM_WAIT_READY"
+
+            with m.State("PARAM_WAIT_READY"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.stream_length.eq(
+                        self.PARAMETER_PAGE_SIZE)
+                    m.d.sync += nand_fsm.read_stream.eq(1)
+                    m.next = "PARAM_READ_END"
+
+            with m.State("PARAM_READ_END"):
+                m.d.sync += nand_fsm.read_stream.eq(0)
+                m.next = "PARAM_STREAM"
+
+            with m.State("PARAM_STREAM"):
+                with m.If(~nand_fsm.busy):
+                    m.d.comb += ftdi_fifo.flush.eq(1)
+                    m.next = "IDLE"
+
+            with m.State("IDLE"):
+                pass
+
+        # FTDI FIFO input always connected to NAND FSM stream output
+        m.d.comb += [ftdi_fifo.tx_buffer.w_data.eq(nand_fsm.stream_data),
+                     ftdi_fifo.tx_buffer.w_en.eq(nand_fsm.stream_valid),
+                     nand_fsm.stream_ready.eq(ftdi_fifo.tx_buffer.w_rdy)]
+
+        return m
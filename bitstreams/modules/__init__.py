@@ -1,5 +1,12 @@
 #!/usr/bin/env python3
 
+from .bch_syndrome import BchSyndrome
 from .blinker import Blinker
+from .clocking import clock_domains
+from .crc32 import Crc32
 from .ftdi_fifo import FtdiFifo
 from .nand_fsm import NandFSM
+from .nand_timing import NAND_TIMINGS, nand_timing, onfi_timing
+from .nand_geometry import NandGeometry
+from .page_buffer import PageBuffer
+from .pll import Pll
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+from nmigen import *
+
+
+class BchSyndrome(Elaboratable):
+    """
+    Partial syndromes of a binary BCH codeword, one byte per cycle
+
+    The codeword is fed MSB first, its first bit being the highest
+    degree coefficient (the bit order used by bchlib). The odd syndromes
+    S1, S3, ... are computed over GF(2^m), all of them being zero for a
+    valid codeword. Errors go unnoticed only if they cancel all the
+    computed syndromes at once.
+
+    Attributes
+    ----------
+    data : Signal
+        Byte to add to the codeword
+    valid : Signal
+        Set to '1' when data holds a byte
+    clear : Signal
+        Set to '1' to start a new codeword, takes precedence over valid
+    dirty : Signal
+        Set to '1' when any computed syndrome isn't zero
+    """
+
+    def __init__(self, poly=0x8003, syndromes=4):
+        """
+            Parameters:
+                poly (int): Primitive polynomial of GF(2^m)
+                syndromes (int): Number of odd syndromes to compute
+        """
+        self.poly = poly
+        self.m = poly.bit_length() - 1
+        self.syndromes = syndromes
+
+        self.data = Signal(8)
+        self.valid = Signal()
+        self.clear = Signal()
+        self.dirty = Signal()
+
+    def gf_mul(self, a, b):
+        result = 0
+        while b:
+            if b & 1:
+                result ^= a
+            b >>= 1
+            a <<= 1
+            if a >> self.m:
+                a ^= self.poly
+        return result
+
+    def gf_pow(self, a, n):
+        result = 1
+        for _ in range(n):
+            result = self.gf_mul(result, a)
+        return result
+
+    def elaborate(self, platform):
+
+        m = Module()
+
+        nonzero = []
+        for j in range(1, 2 * self.syndromes, 2):
+            syndrome = Signal(self.m, name=f"s{j}")
+            nonzero.append(syndrome.any())
+
+            # Horner's rule over a byte:
+            # S = S * alpha^(8j) + sum(data[i] * alpha^(ij))
+            shift = self.gf_pow(2, 8 * j)
+            columns = [(syndrome[k], self.gf_mul(shift, 1 << k))
+                       for k in range(self.m)]
+            columns += [(self.data[i], self.gf_pow(2, i * j))
+                        for i in range(8)]
+
+            next_syndrome = Cat(*(
+                Cat(*(bit for bit, column in columns
+                      if column >> r & 1)).xor()
+                for r in range(self.m)))
+
+            with m.If(self.clear):
+                m.d.sync += syndrome.eq(0)
+            with m.Elif(self.valid):
+                m.d.sync += syndrome.eq(next_syndrome)
+
+        m.d.comb += self.dirty.eq(Cat(*nonzero).any())
+
+        return m
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+from nmigen import *
+
+from .blinker import Blinker
+from .pll import Pll
+
+
+def clock_domains(m, platform, nand_clock=None):
+    """
+    Set up the clocks of a bitstream driving the NAND Flash and the FTDI
+
+    The NAND logic runs in the sync domain, clocked either by the FTDI
+    60 MHz clock or, with nand_clock, by a Pll. In the latter case, the
+    FTDI interface stays in the "usb" domain, on the FTDI clock. The
+    status LED blinks in the FTDI domain.
+
+        Parameters:
+            m (Module): Module of the bitstream
+            platform : NandBugPlatform
+            nand_clock (float): Frequency of the NAND logic (Hz), the FTDI
+                                clock is used if None
+
+        Returns:
+            (sync domain frequency (Hz), name of the FTDI domain)
+    """
+    if nand_clock is not None:
+        pll = Pll(platform.default_clk_frequency, nand_clock)
+        m.submodules += pll
+        clk_frequency = pll.frequency
+        ftdi_domain = "usb"
+    else:
+        clk_frequency = platform.default_clk_frequency
+        ftdi_domain = "sync"
+
+    blink_led = platform.request("led", 0)
+    blinker = DomainRenamer(ftdi_domain)(Blinker(blink_led, 0.5))
+    m.submodules += blinker
+
+    return clk_frequency, ftdi_domain
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+from nmigen import *
+
+
+class Crc32(Elaboratable):
+    """
+    CRC-32 (IEEE 802.3), one byte per cycle
+
+    The result matches zlib.crc32 over the bytes fed since the last clear.
+
+    Attributes
+    ----------
+    data : Signal
+        Byte to add to the CRC
+    valid : Signal
+        Set to '1' when data holds a byte
+    clear : Signal
+        Set to '1' to start a new CRC, takes precedence over valid
+    crc : Signal
+        CRC of the bytes fed so far
+    """
+
+    POLY = 0xEDB88320
+
+    def __init__(self):
+        self.data = Signal(8)
+        self.valid = Signal()
+        self.clear = Signal()
+        self.crc = Signal(32)
+
+    def elaborate(self, platform):
+
+        m = Module()
+
+        state = Signal(32, reset=0xFFFFFFFF)
+
+        # Reflected CRC, unrolled over the 8 bits of data: each bit of the
+        # next state is the XOR of the state and data bits picked by
+        # constant columns, over the 32 state bits then the 8 data bits
+        inputs = [state[k] for k in range(32)] + \
+                 [self.data[i] for i in range(8)]
+        columns = [1 << k for k in range(32)]
+        for i in range(8):
+            feedback = columns[0] ^ (1 << (32 + i))
+            columns = [(columns[k + 1] if k < 31 else 0) ^
+                       (feedback if self.POLY >> k & 1 else 0)
+                       for k in range(32)]
+
+        next_state = Cat(*(
+            Cat(*(bit for n, bit in enumerate(inputs)
+                  if columns[r] >> n & 1)).xor()
+            for r in range(32)))
+
+        with m.If(self.clear):
+            m.d.sync += state.eq(state.reset)
+        with m.Elif(self.valid):
+            m.d.sync += state.eq(next_state)
+
+        m.d.comb += self.crc.eq(~state)
+
+        return m
@@ -1,24 +1,59 @@
 #!/usr/bin/env python3
 
 from nmigen import *
-from nmigen.lib.fifo import AsyncFIFO, SyncFIFO
+from nmigen.lib.cdc import FFSynchronizer
+from nmigen.lib.fifo import AsyncFIFO, SyncFIFO, SyncFIFOBuffered
 
 
 class FtdiFifo(Elaboratable):
     """
     FTDI FIFO Interface, to be used with a FTDI in Sync FIFO Mode
 
+    The FTDI bus is driven from ftdi_domain. If it isn't the sync domain,
+    the buffers are AsyncFIFOs, their user side being in the sync domain.
+
+    Buffers deeper than SMALL_DEPTH are kept in block RAM.
+
     Attributes
     ----------
-    tx_buffer : SyncFIFO
+    tx_buffer : SyncFIFO, SyncFIFOBuffered or AsyncFIFO
         FIFO containing data to be written to the FTDI
-    rx_buffer : SyncFIFO
+    rx_buffer : SyncFIFO, SyncFIFOBuffered or AsyncFIFO
         FIFO containing data read from the FTDI
+    flush : Signal
+        Set to '1' for one cycle once the last byte of a response is
+        written to tx_buffer: SIWU# is strobed as soon as tx_buffer is
+        empty, so the FTDI sends its buffer to the host without waiting
+        for its latency timer
     """
 
-    def __init__(self):
-        self.tx_buffer = SyncFIFO(width=8, depth=16)
-        self.rx_buffer = SyncFIFO(width=8, depth=16)
+    # Largest buffer kept in logic cells
+    SMALL_DEPTH = 16
+
+    def __init__(self, ftdi_domain="sync", tx_depth=16, rx_depth=16):
+        """
+            Parameters:
+                ftdi_domain (str): Clock domain of the FTDI 60 MHz clock
+                tx_depth (int): Depth of tx_buffer (bytes)
+                rx_depth (int): Depth of rx_buffer (bytes), AsyncFIFO
+                                depths are rounded up to a power of 2
+        """
+        self.ftdi_domain = ftdi_domain
+        self.flush = Signal()
+        if ftdi_domain == "sync":
+            self.tx_buffer = self.sync_fifo(tx_depth)
+            self.rx_buffer = self.sync_fifo(rx_depth)
+        else:
+            self.tx_buffer = AsyncFIFO(width=8, depth=tx_depth,
+                                       r_domain=ftdi_domain, w_domain="sync")
+            self.rx_buffer = AsyncFIFO(width=8, depth=rx_depth,
+                                       r_domain="sync", w_domain=ftdi_domain)
+
+    @classmethod
+    def sync_fifo(cls, depth):
+        if depth > cls.SMALL_DEPTH:
+            return SyncFIFOBuffered(width=8, depth=depth)
+        return SyncFIFO(width=8, depth=depth)
 
     def elaborate(self, platform):
 
@@ -35,6 +70,7 @@ class FtdiFifo(Elaboratable):
         oe = platform.request("ftdi_oe")
         rd = platform.request("ftdi_rd")
         data = platform.request("ftdi_data")
+        siwu = platform.request("ftdi_siwua")
 
         write_operation = Signal()
         oe_ready = Signal()
@@ -42,10 +78,10 @@ class FtdiFifo(Elaboratable):
         # Set data bus direction
         with m.If(write_operation):
             m.d.comb += [data.oe.eq(1), oe.eq(1)]
-            m.d.sync += oe_ready.eq(0)  # Add one delay cycle
+            m.d[self.ftdi_domain] += oe_ready.eq(0)  # Add one delay cycle
         with m.Else():
             m.d.comb += [data.oe.eq(0), oe.eq(0)]
-            m.d.sync += oe_ready.eq(1)  # Add one delay cycle
+            m.d[self.ftdi_domain] += oe_ready.eq(1)  # Add one delay cycle
 
         # Manage "write to FTDI" operations
         with m.If((txe == 0) & (self.tx_buffer.r_rdy)):
@@ -67,4 +103,40 @@ class FtdiFifo(Elaboratable):
             m.d.comb += [rd.eq(1),
                          self.rx_buffer.w_en.eq(0)]
 
+        # Manage "Send immediate" requests
+        flush_pending = Signal()
+
+        if self.ftdi_domain == "sync":
+            tx_empty = Signal()
+            if isinstance(self.tx_buffer, SyncFIFOBuffered):
+                m.d.comb += tx_empty.eq(self.tx_buffer.level == 0)
+            else:
+                m.d.comb += tx_empty.eq(~self.tx_buffer.r_rdy)
+            flush_request = self.flush
+        else:
+            # Toggle synchronizer, long enough for the last byte to get
+            # through the AsyncFIFO first
+            tx_empty = ~self.tx_buffer.r_rdy
+            flush_toggle = Signal()
+            flush_toggle_ftdi = Signal()
+            flush_toggle_last = Signal()
+            flush_request = Signal()
+            with m.If(self.flush):
+                m.d.sync += flush_toggle.eq(~flush_toggle)
+            m.submodules += FFSynchronizer(flush_toggle, flush_toggle_ftdi,
+                                           o_domain=self.ftdi_domain,
+                                           stages=4)
+            m.d[self.ftdi_domain] += flush_toggle_last.eq(flush_toggle_ftdi)
+            m.d.comb += flush_request.eq(flush_toggle_ftdi ^
+                                         flush_toggle_last)
+
+        send_immediate = Signal()
+        m.d.comb += [send_immediate.eq(flush_pending & tx_empty &
+                                       ~write_operation),
+                     siwu.eq(~send_immediate)]
+        with m.If(flush_request):
+            m.d[self.ftdi_domain] += flush_pending.eq(1)
+        with m.Elif(send_immediate):
+            m.d[self.ftdi_domain] += flush_pending.eq(0)
+
         return m
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
+import math
 from enum import Enum
 
 from nmigen import *
 from nmigen.back import pysim
 
+from .nand_timing import ONFI_TIMING_MODES
+
 
 class WriteType(Enum):
     CMD = 0
@@ -32,9 +35,69 @@ class NandFSM(Elaboratable):
         Set to '1' if data to be sent is data
     read_data : Signal
         Set to '1' to request a data read
+    read_stream : Signal
+        Set to '1' to read stream_length bytes in a row, one every
+        tRP + tREH
+    stream_length : Signal
+        Number of bytes to be read by read_stream
+    stream_ready : Signal
+        Set to '1' when the stream consumer can accept a byte, RE# is
+        held high otherwise
+    stream_valid : Signal
+        Set to '1' for one cycle when stream_data holds a new byte
+    stream_data : Signal
+        Byte read in streaming mode, valid along with stream_valid
+    wait_ready : Signal
+        Set to '1' along with send_cmd or send_address to wait for the
+        NAND Flash to go busy then ready again once the byte is sent
+    timeout : Signal
+        Set to '1' if the NAND Flash didn't get ready in time
+        during the last wait
     """
 
-    def __init__(self):
+    def __init__(self, tWP=10e-9, tWH=7e-9, tRP=10e-9, tREH=7e-9,
+                 tWB=100e-9, tADL=70e-9, tWHR=80e-9, busy_timeout=2e-6,
+                 ready_timeout=20e-3, timing_mode=None, clk_frequency=None):
+        """
+        The bus timings are rounded up to a whole number of clock cycles,
+        one at least, see NAND_TIMINGS for common sets of values.
+
+        If timing_mode is set, the NAND Flash is switched to this ONFI
+        timing mode with SET FEATURES (0xEF) after every RESET (0xFF)
+        sent with wait_ready, RESET reverting it to timing mode 0.
+
+            Parameters:
+                tWP (float): WE# pulse width (seconds)
+                tWH (float): WE# high hold time (seconds)
+                tRP (float): RE# pulse width (seconds)
+                tREH (float): RE# high hold time (seconds)
+                tWB (float): Delay between WE# rising and R/B# going low
+                             (seconds)
+                tADL (float): Delay between the last address cycle and
+                              the first data cycle (seconds)
+                tWHR (float): Delay between WE# rising, for a command or
+                              address cycle, and RE# falling (seconds)
+                busy_timeout (float): If R/B# doesn't go low for that long
+                                      after tWB, the NAND Flash is
+                                      considered to be ready already
+                                      (seconds)
+                ready_timeout (float): Maximum busy time (seconds)
+                timing_mode (int): ONFI timing mode to set after RESET
+                clk_frequency (float): Frequency of the sync domain (Hz),
+                                       defaults to the platform clock
+                                       frequency
+        """
+        self.tWP = tWP
+        self.tWH = tWH
+        self.tRP = tRP
+        self.tREH = tREH
+        self.tWB = tWB
+        self.tADL = tADL
+        self.tWHR = tWHR
+        self.busy_timeout = busy_timeout
+        self.ready_timeout = ready_timeout
+        self.timing_mode = timing_mode
+        self.clk_frequency = clk_frequency
 
         # Control signals
         self.busy = Signal(reset=1)
@@ -44,6 +107,15 @@ class NandFSM(Elaboratable):
         self.send_address = Signal()
         self.send_data = Signal()
         self.read = Signal()
+        self.wait_ready = Signal()
+        self.timeout = Signal()
+
+        # Streaming read signals
+        self.read_stream = Signal()
+        self.stream_length = Signal(16)
+        self.stream_ready = Signal()
+        self.stream_valid = Signal()
+        self.stream_data = Signal(8)
 
     def elaborate(self, platform):
 
@@ -65,17 +137,104 @@ class NandFSM(Elaboratable):
         # Internal signals
         i_data_buff = Signal(8)
         write_type = Signal(2)
+        wait_after_write = Signal()
+
+        clk_frequency = self.clk_frequency or platform.default_clk_frequency
+
+        def to_cycles(delay):
+            return max(1, int(math.ceil(delay * clk_frequency)))
+
+        # R/B# wait delays, in clock cycles
+        twb_cycles = to_cycles(self.tWB)
+        busy_cycles = to_cycles(self.busy_timeout)
+        ready_cycles = to_cycles(self.ready_timeout)
+        wait_counter = Signal(range(max(twb_cycles, busy_cycles,
+                                        ready_cycles) + 1))
+
+        # Bus timings, in clock cycles. WE# and RE# already stay high for
+        # two cycles between pulses (IDLE, then WRITE or READ), the extra
+        # high time is spent in the *_RECOVER states
+        wp_cycles = to_cycles(self.tWP)
+        wh_recover = max(0, to_cycles(self.tWH) - 2)
+        rp_cycles = to_cycles(self.tRP)
+        reh_cycles = to_cycles(self.tREH)
+        reh_recover = max(0, reh_cycles - 2)
+        adl_cycles = to_cycles(self.tADL)
+        whr_cycles = to_cycles(self.tWHR)
+
+        # Until SET FEATURES is done, the NAND Flash runs in timing mode 0
+        mode0 = ONFI_TIMING_MODES[0]
+        setup_wp_cycles = max(wp_cycles, to_cycles(mode0["tWP"]))
+        setup_wh_recover = max(wh_recover, to_cycles(mode0["tWH"]) - 2)
+        setup_adl_cycles = to_cycles(mode0["tADL"])
+
+        phase = Signal(range(max(setup_wp_cycles, setup_wh_recover,
+                                 rp_cycles, reh_cycles) + 1))
+        adl_counter = Signal(range(max(adl_cycles, setup_adl_cycles) + 1))
+        whr_counter = Signal(range(whr_cycles + 1))
+        stream_remaining = Signal.like(self.stream_length)
+
+        # SET FEATURES sequence: timing mode feature (0x01), parameters
+        setup_bytes = Array([0xEF, 0x01, self.timing_mode or 0, 0, 0, 0])
+        setup_types = Array([WriteType.CMD.value, WriteType.ADDR.value] +
+                            [WriteType.DATA.value] * 4)
+        setup_pending = Signal()
+        in_setup = Signal()
+        setup_step = Signal(range(len(setup_bytes) + 1))
+
+        # Write timings, in clock cycles, slower during SET FEATURES
+        wp_limit = Mux(in_setup, setup_wp_cycles, wp_cycles)
+        wh_limit = Mux(in_setup, setup_wh_recover, wh_recover)
+        adl_limit = Mux(in_setup, setup_adl_cycles, adl_cycles)
 
         # Keep the NAND activated
         m.d.comb += self.ce.eq(0)
 
+        # tADL guard, loaded after each address cycle
+        with m.If(adl_counter != 0):
+            m.d.sync += adl_counter.eq(adl_counter - 1)
+
+        # tWHR guard, loaded after each command or address cycle,
+        # RE# stays high until it expires
+        with m.If(whr_counter != 0):
+            m.d.sync += whr_counter.eq(whr_counter - 1)
+
+        def end_write():
+            with m.If(write_type == WriteType.ADDR):
+                m.d.sync += adl_counter.eq(adl_limit)
+            with m.If(write_type != WriteType.DATA):
+                m.d.sync += whr_counter.eq(whr_cycles)
+            with m.If(wait_after_write):
+                m.d.sync += [wait_after_write.eq(0),
+                             self.timeout.eq(0),
+                             wait_counter.eq(0)]
+                m.next = "WAIT_TWB"
+            with m.Elif(in_setup):
+                m.next = "SETUP"
+            with m.Else():
+                m.next = "IDLE"
+
+        def end_wait():
+            with m.If(setup_pending):
+                m.d.sync += [setup_pending.eq(0),
+                             in_setup.eq(1),
+                             setup_step.eq(0)]
+                m.next = "SETUP"
+            with m.Elif(in_setup):
+                m.next = "SETUP"
+            with m.Else():
+                m.next = "IDLE"
+
         #
         # Main FSM
         #
         with m.FSM() as fsm:
 
             with m.State("IDLE"):
-                with m.If(self.ryby):  # Make sure the NAND Flash is ready
+                # Make sure the NAND Flash is ready. After a timeout, R/B#
+                # is ignored until the next wait, so that a dead bus can't
+                # lock the FSM
+                with m.If((self.ryby | self.timeout) & (adl_counter == 0)):
 
                     # Check which command to run
                     with m.If(self.send_data):
@@ -86,11 +245,16 @@ class NandFSM(Elaboratable):
 
                     with m.Elif(self.send_cmd):
                         m.d.sync += [write_type.eq(WriteType.CMD),
+                                     wait_after_write.eq(self.wait_ready),
                                      self.ale.eq(0)]
+                        if self.timing_mode is not None:
+                            m.d.sync += setup_pending.eq(
+                                self.wait_ready & (self.i_data == 0xFF))
                         m.next = "WRITE"
 
                     with m.Elif(self.send_address):
                         m.d.sync += [write_type.eq(WriteType.ADDR),
+                                     wait_after_write.eq(self.wait_ready),
                                      self.cle.eq(0)]
                         m.next = "WRITE"
 
@@ -99,6 +263,14 @@ class NandFSM(Elaboratable):
                                      self.ale.eq(0)]
                         m.next = "READ"
 
+                    with m.Elif(self.read_stream):
+                        m.d.sync += [self.cle.eq(0),
+                                     self.ale.eq(0),
+                                     self.io_oe.eq(0),
+                                     phase.eq(0),
+                                     stream_remaining.eq(self.stream_length)]
+                        m.next = "STREAM_REH"
+
                     with m.Else():
                         m.d.sync += [self.cle.eq(0), self.ale.eq(0)]
 
@@ -107,7 +279,8 @@ class NandFSM(Elaboratable):
 
                 # When IDLE, keep we and re high & keep busy up
                 # to date
-                m.d.comb += self.busy.eq(self.ryby == 0)
+                m.d.comb += self.busy.eq(((self.ryby == 0) & ~self.timeout)
+                                         | (adl_counter != 0))
                 m.d.sync += [self.we.eq(1), self.re.eq(1)]
 
                 # Sample input data
@@ -117,7 +290,8 @@ class NandFSM(Elaboratable):
                 # Write data to the bus
                 m.d.sync += [self.io_o.eq(i_data_buff),
                              self.we.eq(0),
-                             self.io_oe.eq(1)]
+                             self.io_oe.eq(1),
+                             phase.eq(0)]
 
                 # Set cle or ale if necessary
                 with m.Switch(write_type):
@@ -129,17 +303,135 @@ class NandFSM(Elaboratable):
                 m.next = "WRITE_HOLD"
 
             with m.State("WRITE_HOLD"):
-                m.d.sync += [self.we.eq(1)]
-                m.next = "IDLE"
+                # Keep WE# low for tWP
+                with m.If(phase >= wp_limit - 1):
+                    m.d.sync += [self.we.eq(1), phase.eq(0)]
+                    if setup_wh_recover:
+                        with m.If(wh_limit != 0):
+                            m.next = "WRITE_RECOVER"
+                        with m.Else():
+                            end_write()
+                    else:
+                        end_write()
+                with m.Else():
+                    m.d.sync += phase.eq(phase + 1)
+
+            with m.State("WRITE_RECOVER"):
+                # Keep WE# high, and the bus driven, for the rest of tWH
+                with m.If(phase >= wh_limit - 1):
+                    m.d.sync += phase.eq(0)
+                    end_write()
+                with m.Else():
+                    m.d.sync += phase.eq(phase + 1)
+
+            #
+            # Wait for R/B# to go low, then high again
+            #
+
+            with m.State("WAIT_TWB"):
+                # R/B# can't be trusted before tWB
+                with m.If(wait_counter >= twb_cycles):
+                    m.d.sync += wait_counter.eq(0)
+                    m.next = "WAIT_BUSY"
+                with m.Else():
+                    m.d.sync += wait_counter.eq(wait_counter + 1)
+
+            with m.State("WAIT_BUSY"):
+                with m.If(self.ryby == 0):
+                    m.d.sync += wait_counter.eq(0)
+                    m.next = "WAIT_READY"
+                with m.Elif(wait_counter >= busy_cycles):
+                    # Busy time too short to be noticed
+                    end_wait()
+                with m.Else():
+                    m.d.sync += wait_counter.eq(wait_counter + 1)
+
+            with m.State("WAIT_READY"):
+                with m.If(self.ryby):
+                    end_wait()
+                with m.Elif(wait_counter >= ready_cycles):
+                    m.d.sync += self.timeout.eq(1)
+                    end_wait()
+                with m.Else():
+                    m.d.sync += wait_counter.eq(wait_counter + 1)
+
+            #
+            # SET FEATURES, after RESET
+            #
+
+            with m.State("SETUP"):
+                with m.If(setup_step == len(setup_bytes)):
+                    m.d.sync += in_setup.eq(0)
+                    m.next = "IDLE"
+                with m.Elif(adl_counter == 0):
+                    # Wait for the NAND Flash to be ready once the last
+                    # parameter is written (tFEAT)
+                    m.d.sync += [
+                        i_data_buff.eq(setup_bytes[setup_step]),
+                        write_type.eq(setup_types[setup_step]),
+                        wait_after_write.eq(
+                            setup_step == len(setup_bytes) - 1),
+                        self.cle.eq(0),
+                        self.ale.eq(0),
+                        setup_step.eq(setup_step + 1)]
+                    m.next = "WRITE"
 
             with m.State("READ"):
-                m.d.sync += [self.re.eq(0),
-                             self.io_oe.eq(0)]
-                m.next = "READ_SAMPLE"
+                m.d.sync += self.io_oe.eq(0)
+                with m.If(whr_counter == 0):
+                    m.d.sync += [self.re.eq(0),
+                                 phase.eq(0)]
+                    m.next = "READ_SAMPLE"
 
             with m.State("READ_SAMPLE"):
-                m.d.sync += [self.o_data.eq(self.io_i),
-                             self.re.eq(1)]
-                m.next = "IDLE"
+                # Keep RE# low for tRP, sample the bus just before
+                # releasing it
+                with m.If(phase >= rp_cycles - 1):
+                    m.d.sync += [self.o_data.eq(self.io_i),
+                                 self.re.eq(1),
+                                 phase.eq(0)]
+                    if reh_recover:
+                        m.next = "READ_RECOVER"
+                    else:
+                        m.next = "IDLE"
+                with m.Else():
+                    m.d.sync += phase.eq(phase + 1)
+
+            with m.State("READ_RECOVER"):
+                # Keep RE# high for the rest of tREH
+                with m.If(phase >= reh_recover - 1):
+                    m.d.sync += phase.eq(0)
+                    m.next = "IDLE"
+                with m.Else():
+                    m.d.sync += phase.eq(phase + 1)
+
+            #
+            # Streaming read, the sampled bytes are handed over directly
+            # to the consumer, without going through IDLE
+            #
+
+            with m.State("STREAM_REH"):
+                # RE# high, wait for the consumer before the next byte
+                with m.If(stream_remaining == 0):
+                    m.next = "IDLE"
+                with m.Elif((phase >= reh_cycles - 1)
+                            & self.stream_ready & (whr_counter == 0)):
+                    m.d.sync += [self.re.eq(0),
+                                 phase.eq(0)]
+                    m.next = "STREAM_RP"
+                with m.Elif(phase < reh_cycles - 1):
+                    m.d.sync += phase.eq(phase + 1)
+
+            with m.State("STREAM_RP"):
+                # RE# low, sample the bus just before releasing it
+                with m.If(phase == rp_cycles - 1):
+                    m.d.comb += [self.stream_valid.eq(1),
+                                 self.stream_data.eq(self.io_i)]
+                    m.d.sync += [self.re.eq(1),
+                                 phase.eq(0),
+                                 stream_remaining.eq(stream_remaining - 1)]
+                    m.next = "STREAM_REH"
+                with m.Else():
+                    m.d.sync += phase.eq(phase + 1)
 
         return m
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+
+class NandGeometry(object):
+    """
+    NAND Flash array geometry and addressing
+
+    The defaults describe the NAND Flash of the Google Home Mini. Other
+    chips are described from their ONFI parameter page, see
+    nandbug_platform.NandBugOnfi.
+    """
+
+    def __init__(self, page_size=0x880, pages_per_block=64, blocks=2048,
+                 column_cycles=2, row_cycles=3, timing_mode=None):
+        """
+            Parameters:
+                page_size (int): Page size, spare area included (bytes)
+                pages_per_block (int): Number of pages per block
+                blocks (int): Number of blocks
+                column_cycles (int): Number of column address cycles
+                row_cycles (int): Number of row address cycles, at most 3
+                timing_mode (int): ONFI timing mode to switch to with
+                                   SET FEATURES after each RESET, if any
+        """
+        if row_cycles > 3:
+            raise Exception("Row addresses are at most 3 bytes long")
+
+        self.page_size = page_size
+        self.pages_per_block = pages_per_block
+        self.blocks = blocks
+        self.column_cycles = column_cycles
+        self.row_cycles = row_cycles
+        self.timing_mode = timing_mode
+
+    @property
+    def pages(self):
+        return self.pages_per_block * self.blocks
+
+    @property
+    def block_size(self):
+        return self.pages_per_block * self.page_size
+
+    @property
+    def size(self):
+        return self.pages * self.page_size
+
+    def __repr__(self):
+        return (f"NandGeometry(page_size={self.page_size:#x}, " +
+                f"pages_per_block={self.pages_per_block}, " +
+                f"blocks={self.blocks}, " +
+                f"column_cycles={self.column_cycles}, " +
+                f"row_cycles={self.row_cycles}, " +
+                f"timing_mode={self.timing_mode})")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+
+# ONFI SDR timing modes 0 to 5, as NandFSM bus timings (seconds)
+ONFI_TIMING_MODES = [
+    dict(tWP=50e-9, tWH=30e-9, tRP=50e-9, tREH=30e-9,
+         tWB=200e-9, tADL=200e-9, tWHR=120e-9),
+    dict(tWP=25e-9, tWH=15e-9, tRP=25e-9, tREH=15e-9,
+         tWB=100e-9, tADL=100e-9, tWHR=80e-9),
+    dict(tWP=17e-9, tWH=15e-9, tRP=17e-9, tREH=15e-9,
+         tWB=100e-9, tADL=100e-9, tWHR=80e-9),
+    dict(tWP=15e-9, tWH=10e-9, tRP=15e-9, tREH=10e-9,
+         tWB=100e-9, tADL=100e-9, tWHR=80e-9),
+    dict(tWP=12e-9, tWH=10e-9, tRP=12e-9, tREH=10e-9,
+         tWB=100e-9, tADL=70e-9, tWHR=80e-9),
+    dict(tWP=10e-9, tWH=7e-9, tRP=10e-9, tREH=7e-9,
+         tWB=100e-9, tADL=70e-9, tWHR=80e-9),
+]
+
+# NandFSM bus timings (seconds)
+NAND_TIMINGS = {
+    "fast": ONFI_TIMING_MODES[5],
+    "safe": ONFI_TIMING_MODES[0],
+}
+
+
+def onfi_timing(mode):
+    """
+    Get the NandFSM bus timings of an ONFI timing mode
+
+        Parameters:
+            mode (int): ONFI SDR timing mode, 0 to 5
+
+        Returns:
+            A dict of NandFSM parameters
+    """
+    if not 0 <= mode < len(ONFI_TIMING_MODES):
+        raise Exception(f"Unknown ONFI timing mode {mode}")
+    return dict(ONFI_TIMING_MODES[mode])
+
+
+def nand_timing(profile="fast", custom=None):
+    """
+    Get the NandFSM bus timings of a profile
+
+        Parameters:
+            profile (str): "fast", "safe" or "custom"
+            custom (str): With the "custom" profile, comma separated
+                          timings in nanoseconds, e.g. "tWP=25,tWH=15".
+                          Missing timings are taken from the "safe" profile
+
+        Returns:
+            A dict of NandFSM parameters
+    """
+    if profile == "custom":
+        timing = dict(NAND_TIMINGS["safe"])
+        for item in (custom or "").split(","):
+            if not item:
+                continue
+            name, _, value = item.partition("=")
+            name = name.strip()
+            if name not in timing:
+                raise Exception(f"Unknown NAND timing {name}")
+            timing[name] = float(value) * 1e-9
+        return timing
+
+    if profile not in NAND_TIMINGS:
+        raise Exception(f"Unknown NAND timing profile {profile}")
+    return dict(NAND_TIMINGS[profile])
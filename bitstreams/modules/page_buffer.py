@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+from nmigen import *
+
+
+class PageBuffer(Elaboratable):
+    """
+    Ping-pong page buffer, backed by block RAM
+
+    The buffer is made of two banks of page_size words. One bank is
+    filled while the other one is drained, a bank being handed over to
+    the read side once it holds a whole page. The producer and the
+    consumer then run independently, each at its own rate.
+
+    Both sides follow the first-word-fall-through FIFO interface of
+    nmigen.lib.fifo, but data can only be read once a page is complete.
+
+    With meta_width, each page also carries metadata: a filled bank is
+    only handed over once committed along with its metadata, which can
+    then depend on the whole page.
+
+    Attributes
+    ----------
+    w_data : Signal
+        Word to write
+    w_en : Signal
+        Set to '1' to write w_data
+    w_rdy : Signal
+        Set to '1' when the bank being filled can accept a word
+    r_data : Signal
+        Word to read, valid along with r_rdy
+    r_en : Signal
+        Set to '1' to acknowledge r_data
+    r_rdy : Signal
+        Set to '1' when r_data holds a word
+    empty : Signal
+        Set to '1' when every complete page has been read
+    w_meta : Signal
+        Metadata of the page being committed
+    w_commit : Signal
+        Set to '1' to hand over a filled bank along with w_meta
+    r_meta : Signal
+        Metadata of the page r_data belongs to
+    """
+
+    def __init__(self, page_size, width=8, meta_width=0):
+        """
+            Parameters:
+                page_size (int): Size of a page (words)
+                width (int): Width of a word (bits)
+                meta_width (int): Width of the page metadata (bits), pages
+                                  are handed over without commit if 0
+        """
+        self.page_size = page_size
+        self.width = width
+        self.meta_width = meta_width
+
+        self.w_data = Signal(width)
+        self.w_en = Signal()
+        self.w_rdy = Signal()
+
+        self.r_data = Signal(width)
+        self.r_en = Signal()
+        self.r_rdy = Signal()
+
+        self.empty = Signal()
+
+        self.w_meta = Signal(meta_width)
+        self.w_commit = Signal()
+        self.r_meta = Signal(meta_width)
+
+    def elaborate(self, platform):
+
+        m = Module()
+
+        storage = Memory(width=self.width, depth=2 * self.page_size)
+        w_port = storage.write_port()
+        r_port = storage.read_port(transparent=False)
+        m.submodules += [w_port, r_port]
+
+        # A bank is full from its last word written (or its commit)
+        # until its last word read
+        full = Array([Signal(), Signal()])
+        meta = Array([Signal(self.meta_width), Signal(self.meta_width)])
+
+        # The bank being written is filled, waiting for its commit
+        filled = Signal()
+
+        w_bank = Signal()
+        w_index = Signal(range(self.page_size))
+        r_bank = Signal()
+        r_index = Signal(range(self.page_size))
+
+        #
+        # Write side
+        #
+        write = Signal()
+        m.d.comb += [self.w_rdy.eq(~full[w_bank] & ~filled),
+                     write.eq(self.w_en & self.w_rdy),
+                     w_port.addr.eq(Mux(w_bank, self.page_size, 0) +
+                                    w_index),
+                     w_port.data.eq(self.w_data),
+                     w_port.en.eq(write)]
+
+        with m.If(write):
+            with m.If(w_index == self.page_size - 1):
+                m.d.sync += w_index.eq(0)
+                if self.meta_width:
+                    m.d.sync += filled.eq(1)
+                else:
+                    m.d.sync += [w_bank.eq(~w_bank),
+                                 full[w_bank].eq(1)]
+            with m.Else():
+                m.d.sync += w_index.eq(w_index + 1)
+
+        if self.meta_width:
+            with m.If(self.w_commit & filled):
+                m.d.sync += [filled.eq(0),
+                             w_bank.eq(~w_bank),
+                             full[w_bank].eq(1),
+                             meta[w_bank].eq(self.w_meta)]
+
+        #
+        # Read side, the next word is fetched in the read port
+        # as soon as the current one is acknowledged
+        #
+        fetch = Signal()
+        m.d.comb += [fetch.eq(full[r_bank] & (~self.r_rdy | self.r_en)),
+                     r_port.addr.eq(Mux(r_bank, self.page_size, 0) +
+                                    r_index),
+                     r_port.en.eq(fetch),
+                     self.r_data.eq(r_port.data)]
+
+        with m.If(fetch):
+            m.d.sync += [self.r_rdy.eq(1),
+                         self.r_meta.eq(meta[r_bank])]
+            with m.If(r_index == self.page_size - 1):
+                m.d.sync += [r_index.eq(0),
+                             r_bank.eq(~r_bank),
+                             full[r_bank].eq(0)]
+            with m.Else():
+                m.d.sync += r_index.eq(r_index + 1)
+        with m.Elif(self.r_en):
+            m.d.sync += self.r_rdy.eq(0)
+
+        m.d.comb += self.empty.eq(~full[0] & ~full[1] & ~filled &
+                                  ~self.r_rdy)
+
+        return m
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+from nmigen import *
+from nmigen.lib.cdc import ResetSynchronizer
+
+
+class Pll(Elaboratable):
+    """
+    Clock the sync domain from an iCE40 PLL (SB_PLL40_CORE)
+
+    The PLL is fed by the platform default clock, which remains available
+    as the "usb" domain for the FTDI interface.
+
+    Attributes
+    ----------
+    frequency : float
+        Actual frequency of the sync domain (Hz)
+    """
+
+    # Power-on delay, the iCE40 BRAMs can't be used right
+    # after configuration
+    POR_DELAY = 15e-6
+
+    def __init__(self, f_in, f_out):
+        """
+            Parameters:
+                f_in (float): Input clock frequency (Hz)
+                f_out (float): Requested output frequency (Hz), the
+                               closest achievable one is used
+        """
+        self.f_in = f_in
+        self.divr, self.divf, self.divq, self.frequency = \
+            self.parameters(f_in, f_out)
+
+    @staticmethod
+    def parameters(f_in, f_out):
+        """
+        Find the SB_PLL40 dividers, see iCE40 sysCLOCK PLL Design
+        and Usage Guide
+
+            Returns:
+                (DIVR, DIVF, DIVQ, actual output frequency)
+        """
+        best = None
+        for divr in range(16):
+            f_pfd = f_in / (divr + 1)
+            if not 10e6 <= f_pfd <= 133e6:
+                continue
+            for divf in range(128):
+                f_vco = f_pfd * (divf + 1)
+                if not 533e6 <= f_vco <= 1066e6:
+                    continue
+                for divq in range(1, 7):
+                    f = f_vco / 2**divq
+                    if best is None or abs(f - f_out) < abs(best[3] - f_out):
+                        best = (divr, divf, divq, f)
+        if best is None or not 16e6 <= best[3] <= 275e6:
+            raise Exception(f"Can't generate {f_out / 1e6} MHz " +
+                            f"from {f_in / 1e6} MHz")
+        return best
+
+    def filter_range(self):
+        f_pfd = self.f_in / (self.divr + 1)
+        f_max = [17e6, 26e6, 44e6, 66e6, 101e6]
+        for filter_range in range(len(f_max)):
+            if f_pfd < f_max[filter_range]:
+                return filter_range + 1
+        return len(f_max) + 1
+
+    def elaborate(self, platform):
+
+        m = Module()
+
+        clk_in = platform.request(platform.default_clk).i
+
+        # usb domain, straight from the input clock
+        por_cycles = int(self.POR_DELAY * self.f_in)
+        por_timer = Signal(range(por_cycles + 1))
+        por_done = Signal()
+
+        m.domains.por = ClockDomain("por", reset_less=True, local=True)
+        m.domains.usb = ClockDomain("usb")
+        m.d.comb += [ClockSignal("por").eq(clk_in),
+                     ClockSignal("usb").eq(clk_in),
+                     ResetSignal("usb").eq(~por_done)]
+
+        with m.If(por_timer == por_cycles):
+            m.d.por += por_done.eq(1)
+        with m.Else():
+            m.d.por += por_timer.eq(por_timer + 1)
+
+        # sync domain, from the PLL
+        pll_clk = Signal()
+        pll_lock = Signal()
+        m.submodules.pll = Instance(
+            "SB_PLL40_CORE",
+            p_FEEDBACK_PATH="SIMPLE",
+            p_DIVR=self.divr,
+            p_DIVF=self.divf,
+            p_DIVQ=self.divq,
+            p_FILTER_RANGE=self.filter_range(),
+            i_REFERENCECLK=clk_in,
+            i_RESETB=1,
+            i_BYPASS=0,
+            o_PLLOUTGLOBAL=pll_clk,
+            o_LOCK=pll_lock)
+
+        m.domains.sync = ClockDomain("sync")
+        m.d.comb += ClockSignal("sync").eq(pll_clk)
+        m.submodules += ResetSynchronizer(~pll_lock | ~por_done,
+                                          domain="sync")
+
+        return m
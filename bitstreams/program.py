@@ -6,49 +6,113 @@ from .modules import *
 
 
 class Program(Elaboratable):
+    """
+    Page programming bitstream
 
-    def __init__(self):
-        pass
+    The host sends frames made of a sequence number (1 byte), a page
+    address (3 bytes, little endian) and a page of data. Frames are
+    taken from the FTDI FIFO back-to-back, so the host can keep several
+    of them in flight.
+
+    Bit 23 of the page address requests a cache program (0x15), the host
+    sets it on every page of a run but the last one, which is ended with
+    0x10. The next page is then clocked in while the previous one is being
+    programmed.
+
+    Each page is acknowledged once programmed, with its sequence number,
+    its address and the NAND status register (0x70 command). If R/B#
+    didn't go high in time, 0x00 is reported as status (RDY bit cleared).
+    After a cache program, the status is read as soon as the cache is
+    ready: ARDY is cleared while the page is being programmed, FAIL isn't
+    valid yet and FAILC reports the previous page.
+
+    Frames are double-buffered in block RAM: the next frame is received
+    while the current one is sent to the NAND Flash.
+    """
+
+    # Depth of the FTDI rx FIFO (bytes)
+    RX_DEPTH = 512
+
+    # Frame header size: sequence number and page address
+    HEADER_SIZE = 4
+
+    def __init__(self, timing=None, geometry=None,
+                 nand_clock=None):
+        """
+            Parameters:
+                timing (dict): NandFSM bus timings, see nand_timing()
+                geometry (NandGeometry): NAND Flash geometry
+                nand_clock (float): NAND logic clock frequency (Hz), see
+                                    clock_domains()
+        """
+        self.timing = timing or nand_timing()
+        self.geometry = geometry or NandGeometry()
+        self.nand_clock = nand_clock
 
     def elaborate(self, platform):
 
         m = Module()
 
+        #
+        # Clock domains and status LED
+        #
+        clk_frequency, ftdi_domain = clock_domains(m, platform,
+                                                   self.nand_clock)
+
         #
         # NAND FSM Module
         #
-        nand_fsm = NandFSM()
+        nand_fsm = NandFSM(timing_mode=self.geometry.timing_mode,
+                           clk_frequency=clk_frequency, **self.timing)
         m.submodules += nand_fsm
 
         #
-        # Status LED
+        # Busy LED
         #
-        blink_led = platform.request("led", 0)
-        blinker = Blinker(blink_led, 0.5)
-        m.submodules += blinker
-
         busy_led = platform.request("led", 1)
         m.d.comb += busy_led.eq(~nand_fsm.busy)
 
         #
         # FTDI FIFO Module
         #
-        ftdi_fifo = FtdiFifo()
+        ftdi_fifo = FtdiFifo(ftdi_domain, rx_depth=self.RX_DEPTH)
         m.submodules += ftdi_fifo
 
+        #
+        # Page Buffer Module, holding whole frames
+        #
+        page_buffer = PageBuffer(self.HEADER_SIZE + self.geometry.page_size)
+        m.submodules += page_buffer
+
+        # FTDI FIFO output always connected to the page buffer
+        m.d.comb += [page_buffer.w_data.eq(ftdi_fifo.rx_buffer.r_data),
+                     page_buffer.w_en.eq(ftdi_fifo.rx_buffer.r_rdy),
+                     ftdi_fifo.rx_buffer.r_en.eq(page_buffer.w_rdy)]
+
         #
         # Internal signals
         #
-        page_address = Array([Signal(8) for _ in range(3)])
-        column_address = Array([Signal(8) for _ in range(2)])
-        address = Array([Signal(8) for _ in range(5)])
+        sequence = Signal(8)
+        page_address = [Signal(8) for _ in range(3)]
+        status = Signal(8)
+        header = Array([sequence, *page_address])
+        cache_program = Signal()
+        ack = Array([sequence, *page_address, status])
+        column_address = Array([Signal(8) for _ in
+                                range(self.geometry.column_cycles)])
+        address = Array([Signal(8) for _ in
+                         range(self.geometry.column_cycles +
+                               self.geometry.row_cycles)])
 
         # Multi-purpose counter, large enough
         # to count bytes in a page
-        counter = Signal(range(0, 2177))
+        counter = Signal(range(0, self.geometry.page_size + 1))
 
         # Wire address to column_adrress + page_address
-        m.d.comb += Cat(*address).eq(Cat(*column_address, *page_address))
+        # (bit 23 of page_address is the cache program flag, not sent)
+        m.d.comb += Cat(*address).eq(
+            Cat(*column_address, Cat(*page_address)[:23]))
+        m.d.comb += cache_program.eq(page_address[2][7])
 
         #
         # Writer state machine
@@ -64,27 +128,30 @@ class Program(Elaboratable):
                 with m.If(~nand_fsm.busy):
                     m.d.sync += nand_fsm.i_data.eq(0xFF)
                     m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
                     m.d.sync += counter.eq(0)
                     m.next = "WAIT_RESET"
 
             with m.State("WAIT_RESET"):
                 m.d.sync += nand_fsm.send_cmd.eq(0)
-                with m.If(counter == 500):
-                    m.next = "READ_ADDR"
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_RESET_READY"
+
+            with m.State("WAIT_RESET_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
                     m.d.sync += counter.eq(0)
-                with m.Else():
-                    m.d.sync += counter.eq(counter + 1)
+                    m.next = "READ_ADDR"
 
             #
-            # Read address from FTDI FIFO
+            # Read the frame header from the page buffer
             #
 
             with m.State("READ_ADDR"):
-                with m.If(counter != 3):
-                    with m.If(ftdi_fifo.rx_buffer.r_rdy):
-                        m.d.sync += page_address[counter].eq(
-                            ftdi_fifo.rx_buffer.r_data)
-                        m.d.comb += ftdi_fifo.rx_buffer.r_en.eq(1)
+                with m.If(counter != self.HEADER_SIZE):
+                    with m.If(page_buffer.r_rdy):
+                        m.d.sync += header[counter].eq(page_buffer.r_data)
+                        m.d.comb += page_buffer.r_en.eq(1)
                         m.d.sync += counter.eq(counter+1)
                 with m.Else():
                     m.next = "CMD1"
@@ -105,7 +172,7 @@ class Program(Elaboratable):
                 # Send the 5 bytes of the address
                 m.d.sync += nand_fsm.send_cmd.eq(0)
                 with m.If(~nand_fsm.busy):
-                    with m.If(counter != 5):
+                    with m.If(counter != len(address)):
                         m.d.sync += nand_fsm.i_data.eq(address[counter])
                         m.d.sync += nand_fsm.send_address.eq(1)
                         m.d.sync += counter.eq(counter+1)
@@ -115,16 +182,15 @@ class Program(Elaboratable):
                         m.next = "DATA"
 
             #
-            # Move data from the FTDI FIFO to the NAND Bus
+            # Move data from the page buffer to the NAND Bus
             #
 
             with m.State("DATA"):
                 with m.If(~nand_fsm.busy):
-                    with m.If(counter != 0x880):
-                        with m.If(ftdi_fifo.rx_buffer.r_rdy):
-                            m.d.sync += nand_fsm.i_data.eq(
-                                ftdi_fifo.rx_buffer.r_data)
-                            m.d.comb += ftdi_fifo.rx_buffer.r_en.eq(1)
+                    with m.If(counter != self.geometry.page_size):
+                        with m.If(page_buffer.r_rdy):
+                            m.d.sync += nand_fsm.i_data.eq(page_buffer.r_data)
+                            m.d.comb += page_buffer.r_en.eq(1)
                             m.d.sync += nand_fsm.send_data.eq(1)
                             m.d.sync += counter.eq(counter+1)
                         with m.Else():
@@ -138,28 +204,78 @@ class Program(Elaboratable):
             #
 
             with m.State("CMD2"):
-                # Finish with the 0x10 CMD
+                # Finish with the 0x15 CMD within a run, 0x10 otherwise
+                with m.If(~nand_fsm.busy):
+                    with m.If(cache_program):
+                        m.d.sync += nand_fsm.i_data.eq(0x15)
+                    with m.Else():
+                        m.d.sync += nand_fsm.i_data.eq(0x10)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "WAIT"
+
+            with m.State("WAIT"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_READY"
+
+            with m.State("WAIT_READY"):
+                # Wait for R/B# to go low then high again
                 with m.If(~nand_fsm.busy):
-                    m.d.sync += nand_fsm.i_data.eq(0x10)
+                    m.d.sync += counter.eq(0)
+                    m.next = "STATUS_CMD"
+
+            #
+            # Read the NAND status register
+            #
+
+            with m.State("STATUS_CMD"):
+                with m.If(nand_fsm.timeout):
+                    # Report the timeout with the RDY bit cleared
+                    m.d.sync += status.eq(0x00)
+                    m.next = "SEND_ADDR"
+                # Send the 0x70 CMD
+                with m.Elif(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x70)
                     m.d.sync += nand_fsm.send_cmd.eq(1)
                     m.d.sync += counter.eq(0)
+                    m.next = "STATUS_WAIT"
+
+            with m.State("STATUS_WAIT"):
+                # The NAND FSM holds the read until tWHR is respected
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.next = "STATUS_READ"
+
+            with m.State("STATUS_READ"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.read.eq(1)
+                    m.next = "STATUS_END_READ"
+
+            with m.State("STATUS_END_READ"):
+                m.d.sync += nand_fsm.read.eq(0)
+                m.next = "STATUS"
+
+            with m.State("STATUS"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += status.eq(nand_fsm.o_data)
                     m.next = "SEND_ADDR"
 
             #
-            # Send back the address to FTDI FIFO
-            # (acknowledge the erase command)
+            # Send back the sequence number, address and status
+            # to FTDI FIFO (acknowledge the program command)
             # and loop back
             #
 
             with m.State("SEND_ADDR"):
-                m.d.sync += nand_fsm.send_cmd.eq(0)
-                with m.If(counter != 3):
+                with m.If(counter != 5):
                     with m.If(ftdi_fifo.tx_buffer.w_rdy):
                         m.d.comb += ftdi_fifo.tx_buffer.w_data.eq(
-                            page_address[counter])
+                            ack[counter])
                         m.d.comb += ftdi_fifo.tx_buffer.w_en.eq(1)
                         m.d.sync += counter.eq(counter+1)
                 with m.Else():
+                    m.d.comb += ftdi_fifo.flush.eq(1)
                     m.d.sync += counter.eq(0)
                     m.next = "READ_ADDR"
 
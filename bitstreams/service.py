@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+from nmigen import *
+
+from .modules import *
+
+
+class Service(Elaboratable):
+    """
+    Multi-mode bitstream, running read, erase and program
+    operations requested by the host
+
+    Every request starts with an opcode byte, followed by its operands.
+    Addresses and counts are 3 bytes long, little endian.
+
+        OP_READ, page, count:
+            stream count pages, starting at page
+        OP_ERASE, page:
+            erase the block starting at page, acknowledge with page
+            and the NAND status byte
+        OP_PROGRAM, page, a page of data:
+            program page, acknowledge with page and the NAND status byte
+
+    The status byte is 0x00 (RDY cleared) if R/B# didn't go high in time.
+
+    Any other opcode is ignored.
+    """
+
+    OP_READ = 0x01
+    OP_ERASE = 0x02
+    OP_PROGRAM = 0x03
+
+    def __init__(self, timing=None, geometry=None,
+                 nand_clock=None):
+        """
+            Parameters:
+                timing (dict): NandFSM bus timings, see nand_timing()
+                geometry (NandGeometry): NAND Flash geometry
+                nand_clock (float): NAND logic clock frequency (Hz), see
+                                    clock_domains()
+        """
+        self.timing = timing or nand_timing()
+        self.geometry = geometry or NandGeometry()
+        self.nand_clock = nand_clock
+
+    def elaborate(self, platform):
+
+        m = Module()
+
+        #
+        # Clock domains and status LED
+        #
+        clk_frequency, ftdi_domain = clock_domains(m, platform,
+                                                   self.nand_clock)
+
+        #
+        # NAND FSM Module
+        #
+        nand_fsm = NandFSM(timing_mode=self.geometry.timing_mode,
+                           clk_frequency=clk_frequency, **self.timing)
+        m.submodules += nand_fsm
+
+        #
+        # Busy LED
+        #
+        busy_led = platform.request("led", 1)
+        m.d.comb += busy_led.eq(~nand_fsm.busy)
+
+        # Light up the timeout LED if R/B# ever got stuck
+        timeout_led = platform.request("led", 2)
+        with m.If(nand_fsm.timeout):
+            m.d.sync += timeout_led.eq(1)
+
+        #
+        # FTDI FIFO Module
+        #
+        ftdi_fifo = FtdiFifo(ftdi_domain)
+        m.submodules += ftdi_fifo
+
+        #
+        # Internal signals
+        #
+        opcode = Signal(8)
+        page_address = [Signal(8) for _ in range(3)]
+        page_count = [Signal(8) for _ in range(3)]
+        operands = Array(page_address + page_count)
+        operands_len = Signal(range(7))
+        status = Signal(8)
+        ack = Array(page_address + [status])
+        column_address = Array([Signal(8) for _ in
+                                range(self.geometry.column_cycles)])
+        address = Array([Signal(8) for _ in
+                         range(self.geometry.column_cycles +
+                               self.geometry.row_cycles)])
+
+        # Multi-purpose counter, large enough
+        # to count bytes in a page
+        counter = Signal(range(0, self.geometry.page_size + 1))
+
+        # Wire address to column_adrress + page_address
+        m.d.comb += Cat(*address).eq(Cat(*column_address, *page_address))
+
+        #
+        # Service state machine
+        #
+        with m.FSM() as fsm:
+
+            #
+            # RESET the NAND Flash to a clean state
+            #
+
+            with m.State("RESET"):
+                # Send RESET command (0xFF)
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0xFF)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "WAIT_RESET"
+
+            with m.State("WAIT_RESET"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "WAIT_RESET_READY"
+
+            with m.State("WAIT_RESET_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += counter.eq(0)
+                    m.next = "OPCODE"
+
+            #
+            # Read the request from the FTDI FIFO
+            #
+
+            with m.State("OPCODE"):
+                with m.If(ftdi_fifo.rx_buffer.r_rdy):
+                    m.d.comb += ftdi_fifo.rx_buffer.r_en.eq(1)
+                    m.d.sync += opcode.eq(ftdi_fifo.rx_buffer.r_data)
+                    m.d.sync += counter.eq(0)
+                    with m.Switch(ftdi_fifo.rx_buffer.r_data):
+                        with m.Case(self.OP_READ):
+                            m.d.sync += operands_len.eq(6)
+                            m.next = "OPERANDS"
+                        with m.Case(self.OP_ERASE, self.OP_PROGRAM):
+                            m.d.sync += operands_len.eq(3)
+                            m.next = "OPERANDS"
+
+            with m.State("OPERANDS"):
+                with m.If(counter != operands_len):
+                    with m.If(ftdi_fifo.rx_buffer.r_rdy):
+                        m.d.sync += operands[counter].eq(
+                            ftdi_fifo.rx_buffer.r_data)
+                        m.d.comb += ftdi_fifo.rx_buffer.r_en.eq(1)
+                        m.d.sync += counter.eq(counter+1)
+                with m.Else():
+                    m.d.sync += counter.eq(0)
+                    with m.Switch(opcode):
+                        with m.Case(self.OP_READ):
+                            m.next = "READ_NEXT"
+                        with m.Case(self.OP_ERASE):
+                            m.next = "ERASE_CMD1"
+                        with m.Case(self.OP_PROGRAM):
+                            m.next = "PROGRAM_CMD1"
+
+            #
+            # Read pages, the 0x30 command is used
+            # and the data is streamed by the NAND FSM
+            #
+
+            with m.State("READ_NEXT"):
+                with m.If(Cat(*page_count) != 0):
+                    m.d.sync += Cat(*page_count).eq(Cat(*page_count) - 1)
+                    m.next = "READ_CMD1"
+                with m.Else():
+                    m.d.comb += ftdi_fifo.flush.eq(1)
+                    m.next = "OPCODE"
+
+            with m.State("READ_CMD1"):
+                # Start by sending the 0x00 CMD
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x00)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "READ_ADDR"
+
+            with m.State("READ_ADDR"):
+                # Send the 5 bytes of the address
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                with m.If(~nand_fsm.busy):
+                    with m.If(counter < len(address)):
+                        m.d.sync += nand_fsm.i_data.eq(address[counter])
+                        m.d.sync += nand_fsm.send_address.eq(1)
+                        m.d.sync += counter.eq(counter+1)
+                    with m.Else():
+                        m.d.sync += nand_fsm.send_address.eq(0)
+                        m.next = "READ_CMD2"
+
+            with m.State("READ_CMD2"):
+                # Finish with the 0x30 CMD
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x30)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "READ_WAIT"
+
+            with m.State("READ_WAIT"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "READ_WAIT_READY"
+
+            with m.State("READ_WAIT_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += counter.eq(0)
+                    m.next = "READ"
+
+            with m.State("READ"):
+                # Stream the whole page from the NAND FSM
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.stream_length.eq(
+                        self.geometry.page_size)
+                    m.d.sync += nand_fsm.read_stream.eq(1)
+                    m.next = "READ_END"
+
+            with m.State("READ_END"):
+                m.d.sync += nand_fsm.read_stream.eq(0)
+                m.next = "READ_STREAM"
+
+            with m.State("READ_STREAM"):
+                # Send the read data straight to the FTDI FIFO
+                m.d.comb += [
+                    ftdi_fifo.tx_buffer.w_data.eq(nand_fsm.stream_data),
+                    ftdi_fifo.tx_buffer.w_en.eq(nand_fsm.stream_valid),
+                    nand_fsm.stream_ready.eq(ftdi_fifo.tx_buffer.w_rdy)]
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += Cat(*page_address).eq(Cat(*page_address) + 1)
+                    m.next = "READ_NEXT"
+
+            #
+            # Erase a block
+            #
+
+            with m.State("ERASE_CMD1"):
+                # Start by sending the 0x60 CMD
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x60)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "ERASE_ADDR"
+
+            with m.State("ERASE_ADDR"):
+                # Send the 3 bytes of the address
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                with m.If(~nand_fsm.busy):
+                    with m.If(counter < self.geometry.row_cycles):
+                        m.d.sync += nand_fsm.i_data.eq(operands[counter])
+                        m.d.sync += nand_fsm.send_address.eq(1)
+                        m.d.sync += counter.eq(counter+1)
+                    with m.Else():
+                        m.d.sync += nand_fsm.send_address.eq(0)
+                        m.next = "ERASE_CMD2"
+
+            with m.State("ERASE_CMD2"):
+                # Finish with the 0xD0 CMD
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0xD0)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "ERASE_WAIT"
+
+            with m.State("ERASE_WAIT"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "ERASE_WAIT_READY"
+
+            with m.State("ERASE_WAIT_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += counter.eq(0)
+                    m.next = "STATUS_CMD"
+
+            #
+            # Program a page
+            #
+
+            with m.State("PROGRAM_CMD1"):
+                # Start by sending the 0x80 CMD
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x80)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "PROGRAM_ADDR"
+
+            with m.State("PROGRAM_ADDR"):
+                # Send the 5 bytes of the address
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                with m.If(~nand_fsm.busy):
+                    with m.If(counter != len(address)):
+                        m.d.sync += nand_fsm.i_data.eq(address[counter])
+                        m.d.sync += nand_fsm.send_address.eq(1)
+                        m.d.sync += counter.eq(counter+1)
+                    with m.Else():
+                        m.d.sync += nand_fsm.send_address.eq(0)
+                        m.d.sync += counter.eq(0)
+                        m.next = "PROGRAM_DATA"
+
+            with m.State("PROGRAM_DATA"):
+                # Move data from the FTDI FIFO to the NAND Bus
+                with m.If(~nand_fsm.busy):
+                    with m.If(counter != self.geometry.page_size):
+                        with m.If(ftdi_fifo.rx_buffer.r_rdy):
+                            m.d.sync += nand_fsm.i_data.eq(
+                                ftdi_fifo.rx_buffer.r_data)
+                            m.d.comb += ftdi_fifo.rx_buffer.r_en.eq(1)
+                            m.d.sync += nand_fsm.send_data.eq(1)
+                            m.d.sync += counter.eq(counter+1)
+                        with m.Else():
+                            m.d.sync += nand_fsm.send_data.eq(0)
+                    with m.Else():
+                        m.d.sync += nand_fsm.send_data.eq(0)
+                        m.next = "PROGRAM_CMD2"
+
+            with m.State("PROGRAM_CMD2"):
+                # Finish with the 0x10 CMD
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x10)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += nand_fsm.wait_ready.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "PROGRAM_WAIT"
+
+            with m.State("PROGRAM_WAIT"):
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.d.sync += nand_fsm.wait_ready.eq(0)
+                m.next = "PROGRAM_WAIT_READY"
+
+            with m.State("PROGRAM_WAIT_READY"):
+                # Wait for R/B# to go low then high again
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += counter.eq(0)
+                    m.next = "STATUS_CMD"
+
+            #
+            # Read the NAND status register
+            #
+
+            with m.State("STATUS_CMD"):
+                with m.If(nand_fsm.timeout):
+                    # Report the timeout with the RDY bit cleared
+                    m.d.sync += status.eq(0x00)
+                    m.next = "ACK"
+                # Send the 0x70 CMD
+                with m.Elif(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.i_data.eq(0x70)
+                    m.d.sync += nand_fsm.send_cmd.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "STATUS_WAIT"
+
+            with m.State("STATUS_WAIT"):
+                # The NAND FSM holds the read until tWHR is respected
+                m.d.sync += nand_fsm.send_cmd.eq(0)
+                m.next = "STATUS_READ"
+
+            with m.State("STATUS_READ"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += nand_fsm.read.eq(1)
+                    m.next = "STATUS_END_READ"
+
+            with m.State("STATUS_END_READ"):
+                m.d.sync += nand_fsm.read.eq(0)
+                m.next = "STATUS"
+
+            with m.State("STATUS"):
+                with m.If(~nand_fsm.busy):
+                    m.d.sync += status.eq(nand_fsm.o_data)
+                    m.d.sync += counter.eq(0)
+                    m.next = "ACK"
+
+            #
+            # Send back the address and status to FTDI FIFO
+            # (acknowledge the erase or program command)
+            # and wait for the next request
+            #
+
+            with m.State("ACK"):
+                with m.If(counter != len(ack)):
+                    with m.If(ftdi_fifo.tx_buffer.w_rdy):
+                        m.d.comb += ftdi_fifo.tx_buffer.w_data.eq(
+                            ack[counter])
+                        m.d.comb += ftdi_fifo.tx_buffer.w_en.eq(1)
+                        m.d.sync += counter.eq(counter+1)
+                with m.Else():
+                    m.d.comb += ftdi_fifo.flush.eq(1)
+                    m.d.sync += counter.eq(0)
+                    m.next = "OPCODE"
+
+        return m
@@ -2,3 +2,9 @@
 
 from .ice_ftdi import *
 from .nand_bug_platform import NandBugPlatform
+from .ecc import *
+from .pipeline import *
+from .service import *
+from .onfi import *
+from .digest import *
+from .container import *
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import subprocess
+
+
+__all__ = ["NandBugBitstreamCache"]
+
+
+class NandBugBitstreamCache(object):
+    """
+    Persistent, content-addressed bitstream cache
+
+    Bitstreams are stored under a hash of every file of the build plan
+    (RTLIL netlist, constraints, toolchain scripts and options) and of the
+    toolchain versions. Least recently used entries are evicted once the
+    cache holds more than max_entries bitstreams.
+    """
+
+    TOOLS = [("YOSYS", "yosys", "-V"),
+             ("NEXTPNR_ICE40", "nextpnr-ice40", "--version")]
+
+    def __init__(self, directory=None, max_entries=32):
+        if directory is None:
+            directory = os.environ.get("NANDBUG_CACHE_DIR")
+        if directory is None:
+            cache_home = os.environ.get(
+                "XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+            directory = os.path.join(cache_home, "nandbug")
+
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def _toolchain_version(self):
+        versions = []
+        for env_var, default, version_opt in self.TOOLS:
+            tool = os.environ.get(env_var, default)
+            try:
+                ret = subprocess.run([tool, version_opt],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+                versions.append(ret.stdout)
+            except OSError:
+                versions.append(b"missing")
+        return versions
+
+    def key(self, plan):
+        """
+        Compute the cache key of a nMigen build plan
+        """
+        h = hashlib.sha256()
+        for version in self._toolchain_version():
+            h.update(version)
+        for filename in sorted(plan.files):
+            content = plan.files[filename]
+            if isinstance(content, str):
+                content = content.encode()
+            h.update(filename.encode() + b"\0")
+            h.update(len(content).to_bytes(8, "little"))
+            h.update(content)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def get(self, key):
+        """
+        Return the cached bitstream, or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                bitstream = f.read()
+        except OSError:
+            return None
+        os.utime(path)  # Mark as recently used
+        return bitstream
+
+    def put(self, key, bitstream):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(bitstream)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entries = [os.path.join(self.directory, filename)
+                   for filename in os.listdir(self.directory)
+                   if filename.endswith(".bin")]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[self.max_entries:]:
+            os.remove(path)
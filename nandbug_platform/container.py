@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+import array
+import mmap
+import struct
+import sys
+import zlib
+
+
+__all__ = ["NBD_SUFFIX", "NandBugDumpWriter", "NandBugDumpFile",
+           "is_dump_container", "raw_to_container", "container_to_raw"]
+
+
+# Suffix of dump container files
+NBD_SUFFIX = ".nbd"
+
+# Convert that many pages at once
+CONTAINER_CHUNK_PAGES = 1024
+
+
+class NandBugDumpWriter(object):
+    """
+    Write a NAND Flash dump to an indexed, sparse container
+
+    The file starts with a header holding the chip geometry, followed
+    by the data of the pages which aren't erased (one slot per page,
+    aligned to DATA_ALIGN so that it can be memory-mapped) and by the
+    page index. The index holds one array per field, for every page:
+
+        - its CRC-32, as computed by zlib.crc32 and the Dump bitstream
+          in hash mode
+        - its data slot, ERASED_SLOT if the page is erased (all 0xFF)
+        - its number of corrected bit flips, -1 meaning uncorrectable
+        - its flags, FLAG_ERASED and FLAG_CORRECTED if the flip count is
+          known
+
+    All the integers are little endian.
+    """
+
+    MAGIC = b"NANDBUGD"
+    VERSION = 1
+
+    # Magic, version, page size, pages per block, page count,
+    # data offset, index offset
+    HEADER = struct.Struct("<8sIIIIQQ")
+
+    DATA_ALIGN = 4096
+    INDEX_ALIGN = 8
+
+    ERASED_SLOT = 0xFFFFFFFF
+
+    FLAG_ERASED = 0x01
+    FLAG_CORRECTED = 0x02
+
+    def __init__(self, filename, page_size, pages_per_block):
+        """
+            Parameters:
+                filename : The container to create
+                page_size (int): Page size (bytes)
+                pages_per_block (int): Number of pages per block
+        """
+        self.page_size = page_size
+        self.pages_per_block = pages_per_block
+
+        self.crcs = array.array("I")
+        self.slots = array.array("I")
+        self.flips = array.array("b")
+        self.flags = bytearray()
+
+        self._erased_page = b"\xff" * page_size
+        self._slot_count = 0
+
+        self._file = open(filename, "wb")
+        # The header is written once the index is
+        self._file.write(bytes(self.DATA_ALIGN))
+
+    def write(self, data, flips=None):
+        """
+        Append pages to the container
+
+            Parameters:
+                data : The pages, a multiple of page_size bytes
+                flips : Optional per-page flip counts, as returned
+                        by ecc_fix_chunk
+        """
+        if len(data) % self.page_size:
+            raise Exception("Only whole pages can be written")
+
+        view = memoryview(data)
+        for index, offset in enumerate(range(0, len(data), self.page_size)):
+            page = view[offset:offset + self.page_size]
+            self.crcs.append(zlib.crc32(page))
+
+            page_flags = 0
+            if flips is not None:
+                page_flags |= self.FLAG_CORRECTED
+                self.flips.append(flips[index])
+            else:
+                self.flips.append(0)
+
+            if page == self._erased_page:
+                page_flags |= self.FLAG_ERASED
+                self.slots.append(self.ERASED_SLOT)
+            else:
+                self._file.write(page)
+                self.slots.append(self._slot_count)
+                self._slot_count += 1
+
+            self.flags.append(page_flags)
+
+    def close(self):
+        """
+        Write the page index and the header
+        """
+        index_offset = self._file.tell()
+        index_offset += -index_offset % self.INDEX_ALIGN
+        self._file.seek(index_offset)
+
+        for field in (self.crcs, self.slots, self.flips):
+            if sys.byteorder == "big":
+                field = array.array(field.typecode, field)
+                field.byteswap()
+            self._file.write(field.tobytes())
+        self._file.write(self.flags)
+
+        self._file.seek(0)
+        self._file.write(self.HEADER.pack(
+            self.MAGIC, self.VERSION, self.page_size, self.pages_per_block,
+            len(self.crcs), self.DATA_ALIGN, index_offset))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NandBugDumpFile(object):
+    """
+    Memory-mapped NAND Flash dump container, see NandBugDumpWriter
+
+    Pages are looked up in constant time through the index, erased pages
+    reading as 0xFF. Slicing the container returns the bytes of the raw
+    dump, so that it can be used in place of a raw image.
+    """
+
+    def __init__(self, filename):
+        """
+            Parameters:
+                filename : The container
+        """
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = NandBugDumpWriter.HEADER
+        if len(self._map) < header.size:
+            raise Exception(f"{filename} isn't a dump container")
+        (magic, version, self.page_size, self.pages_per_block, self.pages,
+         self._data_offset, index_offset) = header.unpack_from(self._map)
+        if magic != NandBugDumpWriter.MAGIC:
+            raise Exception(f"{filename} isn't a dump container")
+        if version != NandBugDumpWriter.VERSION:
+            raise Exception(f"Unsupported dump container version {version}")
+
+        self._crcs_offset = index_offset
+        self._slots_offset = self._crcs_offset + 4 * self.pages
+        self._flips_offset = self._slots_offset + 4 * self.pages
+        self._flags_offset = self._flips_offset + self.pages
+
+        self._erased_page = b"\xff" * self.page_size
+
+    @property
+    def blocks(self):
+        return self.pages // self.pages_per_block
+
+    @property
+    def size(self):
+        return self.pages * self.page_size
+
+    def _index(self, offset, typecode):
+        field = array.array(typecode)
+        field.frombytes(self._map[offset:offset + field.itemsize *
+                                  self.pages])
+        if sys.byteorder == "big":
+            field.byteswap()
+        return field
+
+    def digests(self):
+        """
+        Returns:
+            The page CRC-32, as an array("I")
+        """
+        return self._index(self._crcs_offset, "I")
+
+    def flip_map(self):
+        """
+        Returns:
+            The per-page flip counts as an array("b"), 0 for the pages
+            which weren't corrected
+        """
+        return self._index(self._flips_offset, "b")
+
+    def erased_pages(self):
+        """
+        Returns:
+            The ordered list of erased pages
+        """
+        flags = self._map[self._flags_offset:self._flags_offset + self.pages]
+        return [page for page, page_flags in enumerate(flags)
+                if page_flags & NandBugDumpWriter.FLAG_ERASED]
+
+    def erased(self, page):
+        return bool(self._map[self._flags_offset + page] &
+                    NandBugDumpWriter.FLAG_ERASED)
+
+    def flips(self, page):
+        """
+        Returns:
+            The number of corrected bit flips of a page, -1 if it
+            was uncorrectable, None if it wasn't corrected
+        """
+        if not (self._map[self._flags_offset + page] &
+                NandBugDumpWriter.FLAG_CORRECTED):
+            return None
+        return struct.unpack_from("<b", self._map,
+                                  self._flips_offset + page)[0]
+
+    def page(self, page):
+        """
+        Returns:
+            The content of a page
+        """
+        if not 0 <= page < self.pages:
+            raise IndexError(f"Page {page:#x} is out of the dump")
+        slot = struct.unpack_from("<I", self._map,
+                                  self._slots_offset + 4 * page)[0]
+        if slot == NandBugDumpWriter.ERASED_SLOT:
+            return self._erased_page
+        offset = self._data_offset + slot * self.page_size
+        return self._map[offset:offset + self.page_size]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("Dump containers only support contiguous slices")
+        start, stop, _ = key.indices(self.size)
+        if start >= stop:
+            return b""
+        first_page = start // self.page_size
+        last_page = (stop - 1) // self.page_size
+        data = b"".join(self.page(page)
+                        for page in range(first_page, last_page + 1))
+        offset = first_page * self.page_size
+        return data[start - offset:stop - offset]
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_dump_container(filename):
+    """
+    Returns:
+        True if filename is a dump container, rather than a raw dump
+    """
+    with open(filename, "rb") as f:
+        return f.read(len(NandBugDumpWriter.MAGIC)) == \
+            NandBugDumpWriter.MAGIC
+
+
+def raw_to_container(infilename, outfilename, page_size, pages_per_block):
+    """
+    Convert a raw dump to a container, trailing partial pages
+    being discarded
+
+        Parameters:
+            infilename : The raw dump
+            outfilename : The container
+            page_size (int): Page size (bytes)
+            pages_per_block (int): Number of pages per block
+    """
+    chunk_size = CONTAINER_CHUNK_PAGES * page_size
+    with open(infilename, "rb") as f, \
+            NandBugDumpWriter(outfilename, page_size,
+                              pages_per_block) as writer:
+        while True:
+            chunk = f.read(chunk_size)
+            chunk = chunk[:len(chunk) - len(chunk) % page_size]
+            if not chunk:
+                break
+            writer.write(chunk)
+
+
+def container_to_raw(infilename, outfilename):
+    """
+    Convert a container to a raw dump
+
+        Parameters:
+            infilename : The container
+            outfilename : The raw dump
+    """
+    with NandBugDumpFile(infilename) as dump, open(outfilename, "wb") as f:
+        for page in range(dump.pages):
+            f.write(dump.page(page))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import array
+import sys
+import zlib
+
+from .ecc import PAGE_SIZE
+from .container import NandBugDumpFile, is_dump_container
+
+
+__all__ = ["DIGEST_SIZE", "page_digests", "read_digests", "diff_digests"]
+
+
+# Size of a page digest sent by the Dump bitstream in hash mode
+DIGEST_SIZE = 4
+
+# Read that many pages at once when hashing an image
+DIGEST_CHUNK_PAGES = 1024
+
+
+def page_digests(filename, page_size=PAGE_SIZE):
+    """
+    Compute the CRC-32 of each page of an image, as done by the Dump
+    bitstream in hash mode
+
+    The digests of a dump container are read from its index.
+
+        Parameters:
+            filename : The image, raw or a dump container
+            page_size (int): Page size (bytes)
+
+        Returns:
+            The page digests, as an array("I")
+    """
+    if is_dump_container(filename):
+        with NandBugDumpFile(filename) as dump:
+            if dump.page_size != page_size:
+                raise Exception(f"{filename} holds {dump.page_size:#x}" +
+                                "-byte pages")
+            return dump.digests()
+
+    digests = array.array("I")
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(DIGEST_CHUNK_PAGES * page_size)
+            if not chunk:
+                break
+            view = memoryview(chunk)
+            for offset in range(0, len(chunk), page_size):
+                digests.append(zlib.crc32(view[offset:offset + page_size]))
+    return digests
+
+
+def read_digests(fifo, pages):
+    """
+    Receive the page digests sent by the Dump bitstream in hash mode
+
+        Parameters:
+            fifo : A NandBugFtdiFIFO, connected to a Dump bitstream
+            pages (int): Number of pages of the NAND Flash
+
+        Returns:
+            The page digests, as an array("I")
+    """
+    data = bytearray(pages * DIGEST_SIZE)
+    fifo.readinto(data)
+    digests = array.array("I")
+    if digests.itemsize != DIGEST_SIZE:
+        raise Exception("array(\"I\") items aren't 32-bit wide")
+    digests.frombytes(data)
+    # Digests are sent little endian
+    if sys.byteorder == "big":
+        digests.byteswap()
+    return digests
+
+
+def diff_digests(expected, actual):
+    """
+    Compare two lists of page digests
+
+        Returns:
+            The ordered list of pages whose digests differ, pages missing
+            from either list being considered as different
+    """
+    pages = [page for page, (a, b) in enumerate(zip(expected, actual))
+             if a != b]
+    pages.extend(range(min(len(expected), len(actual)),
+                       max(len(expected), len(actual))))
+    return pages
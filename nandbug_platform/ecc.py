@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import array
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import bchlib
+
+from .container import NBD_SUFFIX, NandBugDumpWriter, NandBugDumpFile
+from .container import is_dump_container
+
+
+__all__ = ["PAGE_SIZE", "ecc_fix", "ecc_fix_chunk", "ecc_worker_init",
+           "ecc_worker_fix_chunk"]
+
+
+PAGE_SIZE = 0x880
+DATA_SIZE = 0x820
+ECC_SIZE = 0x880 - 0x820 - 6
+
+# Process that many pages per batch when correcting a dump
+ECC_CHUNK_PAGES = 1024
+
+NIBBLE_SWAP_TABLE = bytes(((c & 0x0F) << 4) | ((c & 0xF0) >> 4)
+                          for c in range(256))
+ERASED_PAGE = b"\xff" * PAGE_SIZE
+
+
+def nibble_swap(data):
+    return bytearray(data).translate(NIBBLE_SWAP_TABLE)
+
+
+def ecc_fix_chunk(bch, chunk, dirty=None):
+    """
+    Correct a batch of pages
+
+    Erased pages are never valid codewords, bch.decode_inplace would leave
+    them untouched. They are skipped entirely, as well as the pages known
+    to be valid codewords already.
+
+        Parameters:
+            bch : A bchlib.BCH instance
+            chunk : Raw pages, a multiple of PAGE_SIZE bytes
+            dirty : Optional per-page flags, pages whose flag isn't set
+                    are known to be valid codewords
+
+        Returns:
+            (corrected pages, per-page flip counts as an array("b"),
+             -1 meaning uncorrectable)
+    """
+    if dirty is not None and not any(dirty):
+        return chunk, array.array("b", bytes(len(chunk) // PAGE_SIZE))
+
+    raw = memoryview(chunk)
+    swapped = nibble_swap(chunk)
+    view = memoryview(swapped)
+
+    flips = array.array("b", bytes(len(swapped) // PAGE_SIZE))
+    for index, offset in enumerate(range(0, len(swapped), PAGE_SIZE)):
+        if dirty is not None and not dirty[index]:
+            continue
+        if raw[offset:offset + PAGE_SIZE] == ERASED_PAGE:
+            continue
+        page_data = view[offset:offset + DATA_SIZE]
+        page_ecc = view[offset + DATA_SIZE:offset + DATA_SIZE + ECC_SIZE]
+        flips[index] = bch.decode_inplace(page_data, page_ecc)
+
+    # Swapping twice leaves the (unswapped) padding bytes untouched
+    return swapped.translate(NIBBLE_SWAP_TABLE), flips
+
+
+#
+# ECC worker processes state, see ecc_fix and NandBugDumpPipeline
+#
+_worker_bch = None
+_worker_dump = None
+_worker_output = None
+
+
+def ecc_worker_init(infilename=None, outfilename=None):
+    """
+    Initializer of the ProcessPoolExecutor workers correcting pages,
+    setting up the BCH decoder of the process
+
+        Parameters:
+            infilename : Optional dump the worker reads pages from,
+                         raw or a dump container
+            outfilename : Optional raw dump the worker writes the
+                          corrected pages to, in place
+    """
+    global _worker_bch, _worker_dump, _worker_output
+
+    _worker_bch = bchlib.BCH(0x8003, 48)
+    if infilename is not None and is_dump_container(infilename):
+        _worker_dump = NandBugDumpFile(infilename)
+    elif infilename is not None:
+        with open(infilename, "rb") as f:
+            _worker_dump = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if outfilename is not None:
+        _worker_output = os.open(outfilename, os.O_WRONLY)
+
+
+def _ecc_fix_range(first_page, page_count):
+    start = first_page * PAGE_SIZE
+    chunk = _worker_dump[start:start + page_count * PAGE_SIZE]
+    corrected, flips = ecc_fix_chunk(_worker_bch, chunk)
+    if _worker_output is None:
+        return corrected, flips
+    os.pwrite(_worker_output, corrected, start)
+    return flips
+
+
+def ecc_worker_fix_chunk(chunk, dirty=None):
+    """
+    Same as ecc_fix_chunk, with the BCH decoder of a worker process
+    set up by ecc_worker_init
+    """
+    return ecc_fix_chunk(_worker_bch, chunk, dirty)
+
+
+def ecc_fix(infilename, outfilename, jobs=None, pages_per_block=64):
+    """
+    Correct a whole dump, splitting it in page ranges
+    decoded in parallel
+
+    Either dump can be a dump container. Corrected pages are written in
+    place to a raw output, or in order to a container along with their
+    flip counts.
+
+        Parameters:
+            infilename : The dump
+            outfilename : The corrected dump, a container if it ends
+                          with NBD_SUFFIX
+            jobs (int): Number of worker processes, defaults
+                        to the number of CPUs
+            pages_per_block (int): Number of pages per block of a raw
+                                   input, recorded in a container output
+
+        Returns:
+            (total number of flipped bits, per-page flip map)
+    """
+    if is_dump_container(infilename):
+        with NandBugDumpFile(infilename) as dump:
+            if dump.page_size != PAGE_SIZE:
+                raise Exception(f"{infilename} holds {dump.page_size:#x}" +
+                                "-byte pages")
+            page_count = dump.pages
+            pages_per_block = dump.pages_per_block
+    else:
+        page_count = os.path.getsize(infilename) // PAGE_SIZE
+
+    if outfilename.endswith(NBD_SUFFIX):
+        writer = NandBugDumpWriter(outfilename, PAGE_SIZE, pages_per_block)
+        worker_outfilename = None
+    else:
+        # Trailing partial pages are discarded, like they always were
+        with open(outfilename, "wb") as f:
+            f.truncate(page_count * PAGE_SIZE)
+        writer = None
+        worker_outfilename = outfilename
+
+    flip_map = array.array("b")
+    if not page_count:
+        if writer:
+            writer.close()
+        return 0, flip_map
+
+    first_pages = range(0, page_count, ECC_CHUNK_PAGES)
+    page_counts = [min(ECC_CHUNK_PAGES, page_count - first_page)
+                   for first_page in first_pages]
+
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=ecc_worker_init,
+                             initargs=(infilename,
+                                       worker_outfilename)) as executor:
+        for result in executor.map(_ecc_fix_range, first_pages, page_counts):
+            if writer:
+                corrected, flips = result
+                writer.write(corrected, flips)
+            else:
+                flips = result
+            flip_map.extend(flips)
+
+    if writer:
+        writer.close()
+
+    total_flips = sum(flips for flips in flip_map if flips > 0)
+
+    return total_flips, flip_map
@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
 
+import collections
+import ctypes
+import math
+import threading
 import time
 import pylibftdi as ftdi
 
@@ -11,6 +15,9 @@ class NandBugFtdiProgrammer(object):
     """
     Configure a iCE40 FPGA in SPI slave mode
     based on iCE40ProgrammingandConfiguration.pdf
+
+    If CDONE stays low after the bitstream is sent, the configuration is
+    retried with the SPI clock halved, down to MIN_SPI_CLOCK.
     """
 
     SPI_SCK = (1 << 0)
@@ -20,7 +27,23 @@ class NandBugFtdiProgrammer(object):
     CRESET_B = (1 << 4)
     CDONE = (1 << 5)
 
-    def __init__(self):
+    # MPSSE base clock, with the divide by 5 prescaler disabled
+    MPSSE_CLOCK = 60e6
+
+    # Default SPI clock, the fastest one the FT2232H can generate
+    SPI_CLOCK = 30e6
+
+    # Slowest SPI clock tried before giving up
+    MIN_SPI_CLOCK = 500e3
+
+    # Largest payload of a MPSSE data command
+    MAX_CMD_BYTES = 64 * 1024
+
+    def __init__(self, spi_clock=SPI_CLOCK):
+        """
+            Parameters:
+                spi_clock (float): SPI clock frequency to try first (Hz)
+        """
         deva = ftdi.Device(interface_select=ftdi.INTERFACE_A)
         deva.ftdi_fn.ftdi_set_bitmode(0x00, 0x00)  # reset
         deva.close()
@@ -28,11 +51,27 @@ class NandBugFtdiProgrammer(object):
         self.dev = ftdi.Device(interface_select=ftdi.INTERFACE_B)
         self.dev.ftdi_fn.ftdi_set_bitmode(0x00, 0x00)  # reset
         self.dev.ftdi_fn.ftdi_set_bitmode(0x03, 0x02)  # MPSSE mode
-        self.set_spi_clock(500e3)
+        self.dev.ftdi_fn.ftdi_write_data_set_chunksize(self.MAX_CMD_BYTES)
+
+        # Disable the clock divide by 5, adaptive clocking
+        # and 3-phase data clocking
+        self.ft_write((0x8A, 0x97, 0x8D))
+
+        self.spi_clock = spi_clock
+        self.set_spi_clock(spi_clock)
 
     def set_spi_clock(self, hz):
-        div = int((12000000 / (hz * 2)) - 1)
+        """
+        Set the SPI clock to the fastest frequency not above hz
+
+            Returns:
+                The actual SPI clock frequency (Hz)
+        """
+        div = max(0, math.ceil(self.MPSSE_CLOCK / (hz * 2)) - 1)
+        if div > 0xFFFF:
+            raise Exception(f"SPI clock too slow: {hz} Hz")
         self.ft_write((0x86, div % 256, div // 256))
+        return self.MPSSE_CLOCK / ((div + 1) * 2)
 
     def ft_write(self, data):
         s = bytes(data)
@@ -40,14 +79,44 @@ class NandBugFtdiProgrammer(object):
         return ret
 
     def ft_write_cmd_bytes(self, cmd, data):
-        n = len(data) - 1
-        self.ft_write([cmd, n % 256, n // 256] + list(data))
+        # Split data in as many commands as needed,
+        # all sent in a single write
+        data = bytes(data)
+        buffer = bytearray()
+        for offset in range(0, len(data), self.MAX_CMD_BYTES):
+            chunk = data[offset:offset + self.MAX_CMD_BYTES]
+            n = len(chunk) - 1
+            buffer += bytes((cmd, n % 256, n // 256)) + chunk
+        self.ft_write(buffer)
 
     def ft_read(self, nbytes):
         s = self.dev.read(nbytes)
         return s
 
     def program(self, bitstream):
+        spi_clock = self.spi_clock
+        while not self.configure(bitstream):
+            spi_clock /= 2
+            if spi_clock < self.MIN_SPI_CLOCK:
+                raise Exception("CDONE=0")
+            self.set_spi_clock(spi_clock)
+        self.spi_clock = spi_clock
+
+    def read_cdone(self):
+        # Read the low GPIO byte, and send it back immediately
+        self.ft_write((0x81, 0x87))
+        ret = b""
+        while not len(ret):
+            ret = self.ft_read(1)
+        return bool(ret[0] & self.CDONE)
+
+    def configure(self, bitstream):
+        """
+        Send the bitstream once, at the current SPI clock
+
+            Returns:
+                True if the FPGA got configured (CDONE=1)
+        """
         # Set SPI_SCK, SPI_SI, CRESET_B and SPI_SS as output low
         output_mask = self.SPI_SCK | self.SPI_SI | self.CRESET_B | self.SPI_SS
         self.ft_write((0x80, self.SPI_SCK, output_mask))
@@ -80,36 +149,220 @@ class NandBugFtdiProgrammer(object):
         self.ft_write_cmd_bytes(0x11, b"\xff" * 7)
 
         # Make sure CDONE=1
-        self.ft_write((0x81,))
-        ret = b""
-        while not len(ret):
-            ret = self.ft_read(1)
-        if not ret[0] & self.CDONE:
-            raise Exception("CDONE=0")
+        if not self.read_cdone():
+            return False
 
         # at least 49 more clocks
         self.ft_write_cmd_bytes(0x11, b"\xff" * 7)
+        return True
 
     def close(self):
         self.dev.close()
 
 
+class _RingBuffer(object):
+    """
+    Thread-safe byte ring buffer, filled by the USB receive thread
+    and drained by NandBugFtdiFIFO.read/readinto
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.c_buffer = (ctypes.c_char * size).from_buffer(self.buffer)
+        self.start = 0
+        self.level = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, address, length):
+        with self.cond:
+            while self.size - self.level < length and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return
+            end = (self.start + self.level) % self.size
+            first = min(length, self.size - end)
+            ctypes.memmove(ctypes.byref(self.c_buffer, end), address, first)
+            ctypes.memmove(self.c_buffer, address + first, length - first)
+            self.level += length
+            self.cond.notify_all()
+
+    def get_into(self, view, block=True):
+        with self.cond:
+            while not self.level and block and not self.closed:
+                self.cond.wait()
+            length = min(len(view), self.level)
+            first = min(length, self.size - self.start)
+            view[:first] = self.view[self.start:self.start + first]
+            view[first:length] = self.view[:length - first]
+            self.start = (self.start + length) % self.size
+            self.level -= length
+            self.cond.notify_all()
+        return length
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
 class NandBugFtdiFIFO(object):
     """
     Communicate with a FT2232H in Sync FIFO Mode
+
+    In streaming mode, a background thread keeps receiving into a ring
+    buffer while the data is consumed and written, and several bulk write
+    transfers are kept queued, only waited for when too many are in
+    flight. The thread stops receiving while the ring buffer is full: the
+    FTDI then holds off the FPGA, so a slow host only slows the transfer
+    down.
     """
 
-    def __init__(self):
+    # Size of the USB transfers used for bulk reads
+    TRANSFER_SIZE = 64 * 1024
+
+    # Default latency timer (ms), bitstreams flush their short responses
+    # with SIWU# instead of waiting for it
+    LATENCY_TIMER = 8
+
+    def __init__(self, streaming=False, transfers=8,
+                 ring_size=16 * 1024 * 1024, latency_timer=LATENCY_TIMER):
+        """
+            Parameters:
+                streaming (bool): Enable the streaming mode
+                transfers (int): Number of USB write transfers kept
+                                 in flight, in streaming mode
+                ring_size (int): Size of the receive ring buffer,
+                                 in streaming mode
+                latency_timer (int): Delay after which the FTDI sends
+                                     an incomplete packet (ms, 1 to 255)
+        """
+        if not 1 <= latency_timer <= 255:
+            raise Exception("The latency timer must be between 1 and 255 ms")
+        if streaming and ring_size < self.TRANSFER_SIZE:
+            raise Exception("The ring buffer must hold at least " +
+                            f"{self.TRANSFER_SIZE} bytes")
+
+        self.streaming = streaming
         self.dev = ftdi.Device(interface_select=ftdi.INTERFACE_A)
-        self.dev.ftdi_fn.ftdi_set_latency_timer(8)
+        self.dev.ftdi_fn.ftdi_set_latency_timer(latency_timer)
+        self.dev.ftdi_fn.ftdi_read_data_set_chunksize(self.TRANSFER_SIZE)
+        self.dev.ftdi_fn.ftdi_write_data_set_chunksize(self.TRANSFER_SIZE)
         self.dev.ftdi_fn.ftdi_set_bitmode(0x00, 0x00)  # reset
         self.dev.ftdi_fn.ftdi_set_bitmode(0x02, 0x40)  # Sync FIFO mode
 
+        if not streaming:
+            return
+
+        self.transfers = transfers
+        self._ring = _RingBuffer(ring_size)
+        self._pending_writes = collections.deque()
+        self._receive_error = None
+
+        self.dev.fdll.ftdi_write_data_submit.restype = ctypes.c_void_p
+        self.dev.fdll.ftdi_transfer_data_done.argtypes = [ctypes.c_void_p]
+
+        self._receive_thread = threading.Thread(target=self._receive,
+                                                daemon=True)
+        self._receive_thread.start()
+
+    def _receive(self):
+        # ftdi_read_data returns what was received when the latency timer
+        # expires, so that closing the ring stops this loop quickly
+        buffer = ctypes.create_string_buffer(self.TRANSFER_SIZE)
+        while not self._ring.closed:
+            ret = self.dev.ftdi_fn.ftdi_read_data(buffer, self.TRANSFER_SIZE)
+            if ret < 0:
+                self._receive_error = self.dev.get_error_string()
+                break
+            # Waits for room: meanwhile the FTDI buffers fill up and
+            # it stops accepting data from the FPGA
+            self._ring.put(ctypes.addressof(buffer), ret)
+        self._ring.close()
+
     def read(self, n=1):
-        return self.dev.read(n)
+        if not self.streaming:
+            return self.dev.read(n)
+
+        data = bytearray(n)
+        length = self._ring.get_into(memoryview(data), block=False)
+        return bytes(data[:length])
+
+    def readinto(self, buffer):
+        """
+        Fill a buffer with data received from the FTDI,
+        using large USB transfers
+
+            Parameters:
+                buffer : A writable bytes-like object
+
+            Returns:
+                The number of bytes received, always len(buffer)
+        """
+        view = memoryview(buffer).cast("B")
+        size = len(view)
+
+        if self.streaming:
+            received = 0
+            while received != size:
+                length = self._ring.get_into(view[received:])
+                if not length:
+                    raise ftdi.FtdiError(
+                        self._receive_error or "Receive stopped")
+                received += length
+            return received
+
+        c_buffer = (ctypes.c_char * size).from_buffer(view)
+
+        received = 0
+        while received != size:
+            length = min(size - received, self.TRANSFER_SIZE)
+            ret = self.dev.ftdi_fn.ftdi_read_data(
+                ctypes.byref(c_buffer, received), length)
+            if ret < 0:
+                raise ftdi.FtdiError(self.dev.get_error_string())
+            received += ret
+
+        return received
 
     def write(self, data):
-        return self.dev.write(data)
+        if not self.streaming:
+            return self.dev.write(data)
+
+        # Each submitted chunk must fit in a single USB transfer,
+        # libftdi would otherwise interleave the remaining parts
+        # of concurrent transfers
+        data = bytes(data)
+        for offset in range(0, len(data), self.TRANSFER_SIZE):
+            chunk = ctypes.create_string_buffer(
+                data[offset:offset + self.TRANSFER_SIZE])
+            tc = self.dev.ftdi_fn.ftdi_write_data_submit(
+                chunk, len(chunk) - 1)
+            if not tc:
+                raise ftdi.FtdiError(self.dev.get_error_string())
+            self._pending_writes.append((tc, chunk))
+            while len(self._pending_writes) > self.transfers:
+                self._wait_write()
+        return len(data)
+
+    def _wait_write(self):
+        tc, _ = self._pending_writes.popleft()
+        if self.dev.fdll.ftdi_transfer_data_done(tc) < 0:
+            raise ftdi.FtdiError(self.dev.get_error_string())
+
+    def flush(self):
+        """
+        Wait for all the pending writes to complete
+        """
+        if self.streaming:
+            while self._pending_writes:
+                self._wait_write()
 
     def close(self):
+        if self.streaming:
+            self.flush()
+            self._ring.close()
+            self._receive_thread.join()
         self.dev.close()
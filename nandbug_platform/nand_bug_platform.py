@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
+import os
+
+from nmigen._toolchain import require_tool
 from nmigen.build import *
 from nmigen.vendor.lattice_ice40 import *
 from nmigen_boards.resources import *
 
 from .ice_ftdi import NandBugFtdiProgrammer
+from .bitstream_cache import NandBugBitstreamCache
 
 
 __all__ = ["NandBugPlatform"]
@@ -53,12 +57,52 @@ class NandBugPlatform(LatticeICE40Platform):
 
     connectors = []
 
-    def toolchain_program(self, products, name):
-        bitstream_data = products.get(f"{name}.bin")
-        prog = NandBugFtdiProgrammer()
+    def __init__(self, cache=None):
+        """
+            Parameters:
+                cache : A NandBugBitstreamCache, a default one is used
+                        if not specified
+        """
+        super().__init__()
+        self.cache = cache if cache is not None else NandBugBitstreamCache()
+
+    def build(self, elaboratable, name="top",
+              build_dir="build", do_build=True,
+              program_opts=None, do_program=False,
+              rebuild=False, **kwargs):
+        """
+        Same as Platform.build, except that when programming, the
+        toolchain is only run if the bitstream isn't cached yet
+        (or if rebuild is set). The toolchain is checked for as by
+        Platform.build, before building.
+        """
+        if not (do_build and do_program):
+            return super().build(elaboratable, name, build_dir, do_build,
+                                 program_opts, do_program, **kwargs)
+
+        plan = self.prepare(elaboratable, name, **kwargs)
+        key = self.cache.key(plan)
+
+        bitstream_data = None if rebuild else self.cache.get(key)
+        if bitstream_data is None:
+            if self._toolchain_env_var not in os.environ:
+                for tool in self.required_tools:
+                    require_tool(tool)
+            products = plan.execute_local(build_dir)
+            bitstream_data = products.get(f"{name}.bin")
+            self.cache.put(key, bitstream_data)
+
+        self.program_bitstream(bitstream_data, **(program_opts or {}))
+
+    def program_bitstream(self, bitstream_data,
+                          spi_clock=NandBugFtdiProgrammer.SPI_CLOCK):
+        prog = NandBugFtdiProgrammer(spi_clock)
         prog.program(bitstream_data)
         prog.close()
 
+    def toolchain_program(self, products, name, **program_opts):
+        self.program_bitstream(products.get(f"{name}.bin"), **program_opts)
+
 
 if __name__ == "__main__":
     from nmigen_boards.test.blinky import *
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import struct
+
+from .ice_ftdi import NandBugFtdiFIFO
+from .nand_bug_platform import NandBugPlatform
+
+
+__all__ = ["NandBugOnfi", "onfi_crc16"]
+
+
+def onfi_crc16(data):
+    """
+    CRC-16 of an ONFI parameter page (polynomial 0x8005, initial value
+    0x4F4E, no reflection)
+    """
+    crc = 0x4F4E
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x8005) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+
+class NandBugOnfi(object):
+    """
+    Decode the output of the Identify bitstream
+
+    The first parameter page copy with a valid signature and CRC is used.
+    """
+
+    ID_SIZE = 8
+    ONFI_ID_SIZE = 4
+    PARAMETER_PAGE_SIZE = 256
+    PARAMETER_PAGE_COPIES = 3
+
+    # Size of the Identify bitstream output
+    SIZE = (ID_SIZE + ONFI_ID_SIZE +
+            PARAMETER_PAGE_COPIES * PARAMETER_PAGE_SIZE)
+
+    def __init__(self, data):
+        """
+            Parameters:
+                data : The SIZE bytes sent by the Identify bitstream
+        """
+        self.id = bytes(data[:self.ID_SIZE])
+        onfi_id = bytes(data[self.ID_SIZE:self.ID_SIZE + self.ONFI_ID_SIZE])
+        if onfi_id != b"ONFI":
+            raise Exception(f"Not an ONFI NAND Flash (ID {self.id.hex()})")
+
+        offset = self.ID_SIZE + self.ONFI_ID_SIZE
+        for _ in range(self.PARAMETER_PAGE_COPIES):
+            page = bytes(data[offset:offset + self.PARAMETER_PAGE_SIZE])
+            offset += self.PARAMETER_PAGE_SIZE
+            crc, = struct.unpack_from("<H", page, 254)
+            if page[:4] == b"ONFI" and onfi_crc16(page[:254]) == crc:
+                break
+        else:
+            raise Exception("No valid ONFI parameter page")
+
+        self.manufacturer = page[32:44].decode("ascii", "replace").strip()
+        self.model = page[44:64].decode("ascii", "replace").strip()
+
+        data_size, spare_size = struct.unpack_from("<IH", page, 80)
+        self.page_size = data_size + spare_size
+        self.pages_per_block, blocks_per_lun = \
+            struct.unpack_from("<II", page, 92)
+        self.luns = page[100]
+        self.blocks = blocks_per_lun * self.luns
+        self.row_cycles = page[101] & 0x0F
+        self.column_cycles = page[101] >> 4
+
+        self.timing_modes, = struct.unpack_from("<H", page, 129)
+        self.tPROG, self.tBERS, self.tR = \
+            struct.unpack_from("<HHH", page, 133)
+
+    @classmethod
+    def read(cls, fifo):
+        """
+        Receive and decode the output of the Identify bitstream
+
+            Parameters:
+                fifo : A NandBugFtdiFIFO, connected to an Identify bitstream
+        """
+        data = bytearray(cls.SIZE)
+        fifo.readinto(data)
+        return cls(data)
+
+    @classmethod
+    def detect(cls, rebuild=False):
+        """
+        Read the NAND Flash ONFI parameter page with the Identify bitstream
+
+            Parameters:
+                rebuild (bool): Rebuild the bitstream instead of using
+                                the cached one
+        """
+        import bitstreams
+
+        p = NandBugPlatform()
+        p.build(bitstreams.Identify(), do_program=True, rebuild=rebuild)
+
+        fifo = NandBugFtdiFIFO()
+        try:
+            return cls.read(fifo)
+        finally:
+            fifo.close()
+
+    @property
+    def timing_mode(self):
+        """
+        Fastest supported ONFI timing mode
+        """
+        return max((mode for mode in range(6)
+                    if self.timing_modes & (1 << mode)), default=0)
+
+    @property
+    def geometry(self):
+        """
+        Geometry parameters, as expected by bitstreams.NandGeometry
+        """
+        return dict(page_size=self.page_size,
+                    pages_per_block=self.pages_per_block,
+                    blocks=self.blocks,
+                    column_cycles=self.column_cycles,
+                    row_cycles=self.row_cycles)
+
+    def __str__(self):
+        return (f"{self.manufacturer} {self.model} (ID {self.id.hex()}), " +
+                f"{self.blocks} blocks of {self.pages_per_block} pages of " +
+                f"{self.page_size:#x} bytes, timing mode {self.timing_mode}")
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import array
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .ecc import PAGE_SIZE, ECC_CHUNK_PAGES
+from .ecc import ecc_worker_init, ecc_worker_fix_chunk
+from .container import NBD_SUFFIX, NandBugDumpWriter
+
+
+__all__ = ["NandBugDumpPipeline"]
+
+
+class NandBugDumpPipeline(object):
+    """
+    Stream a dump from the FPGA to disk, correcting it on the fly
+
+    A reader thread receives chunks of pages from the FTDI FIFO and feeds
+    them to a bounded queue. Chunks are written as they arrive to the raw
+    output and handed to a pool of ECC worker processes, whose results are
+    written in order to the corrected output. Error correction thus overlaps
+    with the USB transfer.
+
+    In framed mode, each page is preceded by a header byte holding its
+    flags (see bitstreams.Dump), and only the pages flagged as dirty go
+    through error correction. Erased pages may also be elided by the
+    bitstream, their header only being sent: they are expanded back
+    to 0xFF bytes, the outputs being identical either way.
+
+    Outputs whose filename ends with NBD_SUFFIX are written as dump
+    containers, erased pages being elided from them.
+    """
+
+    # Frame header and page flags, see bitstreams.Dump
+    FRAME_HEADER = 0xA0
+    FRAME_FLAGS = 0x0F
+    FRAME_DIRTY = 0x01
+    FRAME_ERASED = 0x02
+    FRAME_TIMEOUT = 0x04
+    FRAME_ELIDED = 0x08
+
+    def __init__(self, fifo, size, raw_filename=None,
+                 corrected_filename=None, jobs=None,
+                 chunk_pages=ECC_CHUNK_PAGES, queue_depth=8, framed=False,
+                 page_size=PAGE_SIZE, pages_per_block=64):
+        """
+            Parameters:
+                fifo : A NandBugFtdiFIFO, streaming a Dump bitstream output
+                size (int): Number of page bytes to receive
+                raw_filename : Where to write the raw dump, if any
+                corrected_filename : Where to write the corrected dump,
+                                     if any
+                jobs (int): Number of ECC worker processes, defaults
+                            to the number of CPUs
+                chunk_pages (int): Number of pages per chunk
+                queue_depth (int): Maximum number of chunks waiting to be
+                                   written or corrected
+                framed (bool): The Dump bitstream is in framed mode
+                page_size (int): Page size (bytes)
+                pages_per_block (int): Number of pages per block, recorded
+                                       in dump containers
+        """
+        self.fifo = fifo
+        self.size = size
+        self.raw_filename = raw_filename
+        self.corrected_filename = corrected_filename
+        self.jobs = jobs
+        self.chunk_size = chunk_pages * page_size
+        self.queue_depth = queue_depth
+        self.framed = framed
+        self.page_size = page_size
+        self.pages_per_block = pages_per_block
+
+        # Pages whose read timed out, and erased pages, in framed mode
+        self.timeout_pages = []
+        self.erased_pages = []
+
+        self._queue = queue.Queue(maxsize=queue_depth)
+
+    def _open_output(self, filename):
+        if not filename:
+            return None
+        if filename.endswith(NBD_SUFFIX):
+            return NandBugDumpWriter(filename, self.page_size,
+                                     self.pages_per_block)
+        return open(filename, "wb")
+
+    def _receive_frames(self, chunk):
+        view = memoryview(chunk)
+        header = bytearray(1)
+        erased_page = b"\xff" * self.page_size
+        flags = bytearray(len(chunk) // self.page_size)
+        for index, offset in enumerate(range(0, len(chunk),
+                                             self.page_size)):
+            self.fifo.readinto(header)
+            if header[0] & ~self.FRAME_FLAGS != self.FRAME_HEADER:
+                raise Exception(f"Unexpected frame header {header[0]:#04x}")
+            flags[index] = header[0] & self.FRAME_FLAGS
+            if flags[index] & self.FRAME_ELIDED:
+                view[offset:offset + self.page_size] = erased_page
+            else:
+                self.fifo.readinto(view[offset:offset + self.page_size])
+        return flags
+
+    def _receive(self):
+        try:
+            remaining = self.size
+            while remaining:
+                chunk = bytearray(min(self.chunk_size, remaining))
+                if self.framed:
+                    flags = self._receive_frames(chunk)
+                else:
+                    self.fifo.readinto(chunk)
+                    flags = None
+                self._queue.put((chunk, flags))
+                remaining -= len(chunk)
+            self._queue.put(None)
+        except Exception as e:
+            self._queue.put(e)
+
+    def run(self, progress=None):
+        """
+        Receive the whole dump
+
+            Parameters:
+                progress : Optional callable, called with the number of
+                           bytes received so far
+
+            Returns:
+                (total number of flipped bits, per-page flip map), the flip
+                map being empty when no correction is performed
+        """
+        raw = self._open_output(self.raw_filename)
+        corrected = None
+        executor = None
+        if self.corrected_filename:
+            corrected = self._open_output(self.corrected_filename)
+            executor = ProcessPoolExecutor(max_workers=self.jobs,
+                                           initializer=ecc_worker_init)
+
+        flip_map = array.array("b")
+        pending = deque()
+
+        def write_corrected():
+            data, flips = pending.popleft().result()
+            if isinstance(corrected, NandBugDumpWriter):
+                corrected.write(data, flips)
+            else:
+                corrected.write(data)
+            flip_map.extend(flips)
+
+        receiver = threading.Thread(target=self._receive, daemon=True)
+        receiver.start()
+
+        try:
+            received = 0
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                chunk, flags = item
+
+                dirty = None
+                if flags is not None:
+                    first_page = received // self.page_size
+                    self.timeout_pages.extend(
+                        first_page + index
+                        for index, page_flags in enumerate(flags)
+                        if page_flags & self.FRAME_TIMEOUT)
+                    self.erased_pages.extend(
+                        first_page + index
+                        for index, page_flags in enumerate(flags)
+                        if page_flags & self.FRAME_ERASED)
+                    # Erased pages never need correction
+                    dirty = bytes(page_flags & self.FRAME_DIRTY and
+                                  not page_flags & self.FRAME_ERASED
+                                  for page_flags in flags)
+
+                if raw:
+                    raw.write(chunk)
+
+                if executor:
+                    pending.append(executor.submit(ecc_worker_fix_chunk, chunk,
+                                                   dirty))
+                    while pending and (pending[0].done()
+                                       or len(pending) > self.queue_depth):
+                        write_corrected()
+
+                received += len(chunk)
+                if progress:
+                    progress(received)
+
+            while pending:
+                write_corrected()
+
+        finally:
+            if executor:
+                executor.shutdown()
+                corrected.close()
+            if raw:
+                raw.close()
+
+        total_flips = sum(flips for flips in flip_map if flips > 0)
+
+        return total_flips, flip_map
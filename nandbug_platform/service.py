@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import struct
+
+
+__all__ = ["NandBugService"]
+
+
+class NandBugService(object):
+    """
+    Host side of the Service bitstream protocol
+
+    A single Service configuration can read, erase and program the
+    NAND Flash, see bitstreams.Service for the protocol details.
+    """
+
+    OP_READ = 0x01
+    OP_ERASE = 0x02
+    OP_PROGRAM = 0x03
+
+    PAGE_SIZE = 0x880
+
+    STATUS_FAIL = 0x01
+    STATUS_READY = 0x40
+
+    def __init__(self, fifo, page_size=PAGE_SIZE):
+        """
+            Parameters:
+                fifo : A NandBugFtdiFIFO, connected to a Service bitstream
+                page_size (int): NAND Flash page size (bytes)
+        """
+        self.fifo = fifo
+        self.page_size = page_size
+
+    @staticmethod
+    def _pack24(value):
+        return struct.pack("<I", value)[:3]
+
+    def _wait_ack(self, page, operation):
+        expected = self._pack24(page)
+        ack = bytearray(4)
+        self.fifo.readinto(ack)
+        if ack[:3] != expected:
+            raise Exception(f"Unexpected acknowledgement {ack.hex()} " +
+                            f"for page {page:#x}")
+        if not ack[3] & self.STATUS_READY:
+            raise Exception(f"Timeout while {operation} page {page:#x}")
+        if ack[3] & self.STATUS_FAIL:
+            raise Exception(f"Failed {operation} page {page:#x}")
+
+    def request_read(self, page, count):
+        """
+        Request count pages starting at page, the data
+        is then to be read from the FIFO
+        """
+        self.fifo.write(bytes([self.OP_READ]) + self._pack24(page) +
+                        self._pack24(count))
+
+    def read_pages(self, page, count):
+        """
+        Read count pages starting at page
+        """
+        self.request_read(page, count)
+        data = bytearray(count * self.page_size)
+        self.fifo.readinto(data)
+        return data
+
+    def erase_block(self, page):
+        """
+        Erase the block starting at page
+        """
+        self.fifo.write(bytes([self.OP_ERASE]) + self._pack24(page))
+        self._wait_ack(page, "erasing the block at")
+
+    def program_page(self, page, data):
+        """
+        Program page with data, page_size bytes long
+        """
+        if len(data) != self.page_size:
+            raise ValueError(f"Page data must be {self.page_size} bytes long")
+        self.fifo.write(bytes([self.OP_PROGRAM]) + self._pack24(page) +
+                        bytes(data))
+        self._wait_ack(page, "programming")